@@ -1,3 +1,4 @@
+import hashlib
 import logging
 
 import requests
@@ -7,7 +8,9 @@ from requests.packages.urllib3.util.retry import Retry
 from furl import furl
 
 
+from .cache import ResponseCache
 from .tunnel import SSHTunnelsContainer
+from .utils import iter_json_array
 
 
 log = logging.getLogger('scli')
@@ -23,12 +26,35 @@ PATHS = {
     'column_family': '/column_family/',
     'repair_async': '/storage_service/repair_async/{keyspace}',
     'active_repair': '/storage_service/active_repair/',
+    'pending_compactions': '/compaction_manager/metrics/pending_tasks',
+    'compactions': '/compaction_manager/compactions',
 }
+# seconds to cache responses of read-only calls, 0 only coalesces
+# concurrent calls
+CACHE_TTL = {
+    'cluster_name': 3600,
+    'column_family': 60,
+    'datacenter': 300,
+    'tokens': 60,
+    'endpoints_simple': 5,
+    'active_repair': 1,
+    'pending_compactions': 5,
+    'compactions': 5,
+}
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class ResponseChanged(exceptions.RequestException):
+    """
+    Streamed response broke after some elements were already consumed and
+    the response sent again does not start with the same elements
+    """
 
 
 class ApiClient:
     def __init__(self, uses_ssh=True, initial_endpoint=None, port=10000,
-                 timeout=(5, 5), total_retries=10, backoff_factor=5):
+                 timeout=(5, 5), total_retries=10, backoff_factor=5,
+                 cache_ttl=None, cache_size=256):
 
         self.initial_endpoint = initial_endpoint
         self.port = port
@@ -45,18 +71,55 @@ class ApiClient:
 
         self.uses_ssh = uses_ssh
         self._tunnels_container = None
+        self._ssh_settings = None
+        self._session = None
+
+        self.cache_ttl = dict(CACHE_TTL, **(cache_ttl or {}))
+        self.cache = ResponseCache(max_size=cache_size)
 
     def setup_ssh(self, initial_endpoint=None, ssh_username=None,
                   ssh_pkey=None, ssh_pass=None):
 
         self.uses_ssh = True
+        self._ssh_settings = dict(
+            initial_endpoint=initial_endpoint,
+            ssh_username=ssh_username,
+            ssh_pkey=ssh_pkey,
+            ssh_pass=ssh_pass)
         self._tunnels_container = SSHTunnelsContainer(
             ssh_username=ssh_username,
             ssh_pkey=ssh_pkey,
             ssh_pass=ssh_pass,
             initial_endpoint=initial_endpoint)
 
+    def clone(self):
+        """
+        Client with the same settings, but its own session, SSH tunnels and
+        cache, so it can be used by another thread
+        """
+        client = ApiClient(
+            uses_ssh=self.uses_ssh,
+            initial_endpoint=self.initial_endpoint,
+            port=self.port,
+            timeout=self.timeout,
+            total_retries=self.total_retries,
+            backoff_factor=self.backoff_factor,
+            cache_ttl=self.cache_ttl,
+            cache_size=self.cache.max_size,
+        )
+        if self._ssh_settings is not None:
+            client.setup_ssh(**self._ssh_settings)
+        client.set_hosts(self._hosts)
+        return client
+
+    def set_hosts(self, hosts):
+        """
+        Hosts which requests can be sent to, set by `endpoints_*` calls
+        """
+        self._hosts = list(hosts)
+
     def stop_ssh(self):
+        self.close()
         if not self.uses_ssh:
             return
 
@@ -73,39 +136,60 @@ class ApiClient:
 
         return self.base_url_tpl.format(host=_host, port=_port)
 
-    def _send_request(self, req_type, url, data=None, headers=None, attempt=1):
+    @property
+    def session(self):
+        """
+        Session shared by all requests, so HTTP connections are kept alive
+        between calls instead of being opened again for every request
+        """
+        if self._session is None:
+            s = requests.Session()
+            retry = Retry(
+                total=self.total_retries,
+                read=self.total_retries,
+                connect=self.total_retries,
+                backoff_factor=self.backoff_factor,
+            )
+            adapter = HTTPAdapter(max_retries=retry)
+            s.mount('http://', adapter)
+            self._session = s
+
+        return self._session
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def _send_request(self, req_type, url, data=None, headers=None, attempt=1,
+                      stream=False, retries=None):
         req = requests.Request(req_type, url, data=data or {},
                                headers=headers)
         prepped = req.prepare()
 
-        s = requests.Session()
-        retry = Retry(
-            total=self.total_retries,
-            read=self.total_retries,
-            connect=self.total_retries,
-            backoff_factor=self.backoff_factor,
-        )
-        adapter = HTTPAdapter(max_retries=retry)
-        s.mount('http://', adapter)
+        s = self.session
         settings = s.merge_environment_settings(prepped.url, {}, None, None,
                                                 None)
         try:
-            resp = s.send(prepped, timeout=self.timeout, **settings)
+            resp = s.send(prepped, timeout=self.timeout, stream=stream,
+                          **settings)
             resp.raise_for_status()
             return resp
         except exceptions.RequestException as e:
             log.error(str(e))
-            if attempt > self.total_retries:
+            if attempt > (self.total_retries if retries is None else retries):
                 raise e
 
             if self.uses_ssh and issubclass(
                     e.__class__, exceptions.ConnectionError):
                 self._tunnels_container.reset()
             return self._send_request(
-                req_type, url, data=data, headers=headers, attempt=attempt+1)
+                req_type, url, data=data, headers=headers, attempt=attempt+1,
+                stream=stream, retries=retries)
 
-    def _request(self, req_type, path, data=None, host=None, json=True):
-        headers = self.base_headers
+    def _request(self, req_type, path, data=None, host=None, json=True,
+                 stream=False, retries=None):
+        headers = dict(self.base_headers)
         if host is not None:
             assert host in self._hosts, '{} is not part of the cluster!'\
                 .format(host)
@@ -116,22 +200,100 @@ class ApiClient:
         url.add(data or {})
 
         resp = self._send_request(
-            req_type, url.url, data=data or {}, headers=headers)
+            req_type, url.url, data=data or {}, headers=headers,
+            stream=stream, retries=retries)
+        if stream:
+            return resp
         return resp.json() if json else resp.text
 
-    def _get(self, path, data=None, host=None, json=True):
-        return self._request('GET', path, data=data, host=host, json=json)
+    def _get(self, path, data=None, host=None, json=True, retries=None):
+        return self._request('GET', path, data=data, host=host, json=json,
+                             retries=retries)
+
+    def _cached_get(self, name, path, data=None, host=None, retries=None):
+        """
+        GET through the response cache, identical concurrent calls are sent
+        only once. Must be used for read-only endpoints only.
+        :param name: key of `CACHE_TTL`
+        :param retries: overrides `total_retries`
+        """
+        key = (path, host, tuple(sorted((data or {}).items())))
+        return self.cache.get_or_fetch(
+            key, self.cache_ttl.get(name, 0),
+            lambda: self._get(path, data=data, host=host, retries=retries))
+
+    def _get_iter(self, path, data=None, host=None, key=None):
+        """
+        GET JSON array and yield its elements while the response is still
+        being downloaded. Used for responses which grow with the cluster.
+
+        If the connection breaks while reading the body, the request is
+        sent again (resetting SSH tunnels) and elements already yielded are
+        skipped. They are compared by checksum with the ones yielded before
+        and `ResponseChanged` is raised if they differ.
+        :param key: function returning identity of element, only identities
+            are compared after reconnecting (whole elements by default)
+        """
+        if key is None:
+            def key(item):
+                return item
+
+        yielded = 0
+        checksum = hashlib.sha1()
+        attempt = 1
+
+        while True:
+            resp = self._request(
+                'GET', path, data=data, host=host, stream=True)
+            # elements yielded before this attempt
+            to_skip = yielded
+            skipped = 0
+            skipped_checksum = hashlib.sha1()
+            try:
+                for item in iter_json_array(
+                        resp.iter_content(chunk_size=STREAM_CHUNK_SIZE)):
+                    if skipped < to_skip:
+                        skipped_checksum.update(repr(key(item)).encode())
+                        skipped += 1
+                        if skipped == to_skip and \
+                                skipped_checksum.digest() != \
+                                checksum.digest():
+                            raise ResponseChanged(
+                                'Response of {} changed after reconnecting'
+                                .format(path))
+                        continue
+
+                    checksum.update(repr(key(item)).encode())
+                    yielded += 1
+                    yield item
+
+                if skipped < to_skip:
+                    raise ResponseChanged(
+                        'Response of {} changed after reconnecting'.format(
+                            path))
+                return
+            except (exceptions.ConnectionError,
+                    exceptions.ChunkedEncodingError) as e:
+                log.error(str(e))
+                if attempt > self.total_retries:
+                    raise e
+
+                attempt += 1
+                if self.uses_ssh:
+                    self._tunnels_container.reset()
+            finally:
+                resp.close()
 
     def _post(self, path, data, host=None, json=True):
         return self._request('POST', path, data=data, host=host, json=json)
 
     def cluster_name(self):
-        return self._get(PATHS['cluster_name'])
+        return self._cached_get('cluster_name', PATHS['cluster_name'])
 
     def endpoints_detailed(self):
         """
-        Get all endpoint states
-        "return: [
+        Get all endpoint states, parsed incrementally
+        :yield: [
           {
             "update_time": 1552310205453,
             "generation": 0,
@@ -143,10 +305,15 @@ class ApiClient:
           ...
         ]
         """
-        endpoints = self._get(PATHS['endpoints'])
-        self._hosts = [e['addrs'] for e in endpoints]
+        hosts = []
+        # states and heartbeats change between requests, endpoints
+        # are told apart by address only
+        for endpoint in self._get_iter(PATHS['endpoints'],
+                                       key=lambda e: e['addrs']):
+            hosts.append(endpoint['addrs'])
+            yield endpoint
 
-        return endpoints
+        self._hosts = hosts
 
     def endpoints_simple(self):
         """
@@ -157,22 +324,30 @@ class ApiClient:
           }
         ]
         """
-        endpoints = self._get(PATHS['endpoints_simple'])
+        endpoints = self._cached_get(
+            'endpoints_simple', PATHS['endpoints_simple'])
         self._hosts = [e['key'] for e in endpoints]
 
         return endpoints
 
     def tokens(self, endpoint):
-        return self._get(PATHS['tokens'].format(endpoint=endpoint))
+        return self._cached_get(
+            'tokens', PATHS['tokens'].format(endpoint=endpoint))
 
     def datacenter(self, endpoint):
-        return self._get(PATHS['datacenter'], data={'host': endpoint})
+        return self._cached_get(
+            'datacenter', PATHS['datacenter'], data={'host': endpoint})
 
     def describe_ring(self, keyspace):
-        return self._get(PATHS['describe_ring'].format(keyspace=keyspace))
+        """
+        Token ranges of keyspace, parsed incrementally
+        """
+        return self._get_iter(
+            PATHS['describe_ring'].format(keyspace=keyspace),
+            key=lambda r: (r['start_token'], r['end_token']))
 
     def tables(self):
-        return self._get(PATHS['column_family'])
+        return self._cached_get('column_family', PATHS['column_family'])
 
     def repair_async(self, host, keyspace, table, start_token=None,
                      end_token=None, dc=None):
@@ -195,4 +370,20 @@ class ApiClient:
                          data={'id': repair_id}, host=host, json=False)
 
     def active_repair(self, host):
-        return self._get(PATHS['active_repair'], host=host)
+        return self._cached_get(
+            'active_repair', PATHS['active_repair'], host=host)
+
+    def pending_compactions(self, host):
+        """
+        Not retried, backlog is probed again by the caller anyway
+        """
+        return self._cached_get(
+            'pending_compactions', PATHS['pending_compactions'], host=host,
+            retries=0)
+
+    def compactions(self, host):
+        """
+        Compactions currently running on host, not retried
+        """
+        return self._cached_get('compactions', PATHS['compactions'],
+                                host=host, retries=0)
@@ -0,0 +1,92 @@
+from collections import OrderedDict
+import threading
+from time import monotonic
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ResponseCache:
+    """
+    Read-through cache for idempotent API calls. Concurrent calls with the
+    same key are coalesced into a single fetch, results are kept for `ttl`
+    seconds and the least recently used ones are evicted above `max_size`.
+    Cached values are shared between callers and must not be mutated.
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+        self._entries = OrderedDict()  # key: (expires_at, value)
+        self._in_flight = {}  # key: _Call
+        self._lock = threading.Lock()
+
+    def get_or_fetch(self, key, ttl, fetch):
+        """
+        :param ttl: seconds to keep the result, 0 only coalesces calls
+        :param fetch: function called on cache miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                self.misses += 1
+                call = _Call()
+                self._in_flight[key] = call
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fetch()
+        except BaseException as e:
+            # followers must not take None for a valid response, also
+            # on KeyboardInterrupt and alike
+            call.error = e
+            raise
+        else:
+            if ttl > 0:
+                self._store(key, ttl, call.result)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call.done.set()
+
+        return call.result
+
+    def _store(self, key, ttl, value):
+        with self._lock:
+            self._entries[key] = (monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'size': len(self._entries),
+        }
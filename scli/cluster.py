@@ -24,9 +24,6 @@ class Endpoint:
 
 
 class Keyspace:
-    name = None
-    tables = set()
-
     def __init__(self, name, tables):
         self.name = name
         self.tables = tables
@@ -53,27 +50,40 @@ class Ring:
 
 
 class Cluster:
-    name = None
-    endpoints = {}
-    keyspaces = {}
-
-    def __init__(self, client):
+    def __init__(self, client, endpoints=None):
         self.client = client
+        self.endpoints = {}
+        self.keyspaces = {}
         self.name = self.client.cluster_name()
-        self.initialize_endpoints()
+        self.initialize_endpoints(endpoints)
         self.initialize_keyspaces()
 
-    def initialize_keyspaces(self):
+    def initialize_keyspaces(self, tables=None):
+        if tables is None:
+            tables = self.client.tables()
         keyspace_tables = defaultdict(set)
 
-        for table_data in self.client.tables():
+        for table_data in tables:
             keyspace_tables[table_data['ks']].add(table_data['cf'])
 
         for keyspace, tables in keyspace_tables.items():
             self.keyspaces[keyspace] = Keyspace(keyspace, tables)
 
-    def initialize_endpoints(self):
-        endpoints = self.client.endpoints_detailed()
+    def refresh(self, endpoints=None, tables=None):
+        """
+        Fetch cluster topology again, dropping endpoints and keyspaces
+        which are gone
+        :param endpoints: already fetched `endpoints_detailed` response
+        :param tables: already fetched `tables` response
+        """
+        self.endpoints = {}
+        self.keyspaces = {}
+        self.initialize_endpoints(endpoints)
+        self.initialize_keyspaces(tables)
+
+    def initialize_endpoints(self, endpoints=None):
+        if endpoints is None:
+            endpoints = self.client.endpoints_detailed()
         for data in endpoints:
             self.endpoints[data['addrs']] = Endpoint(
                 data['addrs'],
@@ -92,10 +102,20 @@ class Cluster:
 
         return endpoints
 
+    @property
+    def nodes_down_by_dc(self):
+        """
+        :return: {'dc': [..names of endpoints down]}
+        """
+        nodes_down = defaultdict(list)
+        for e in self.endpoints.values():
+            if not e.is_alive:
+                nodes_down[e.dc].append(e.name)
+
+        return nodes_down
+
     def status(self):
         field_names = ['State', 'Address', 'Load', 'Tokens', 'Version', 'Rack']
-        nodes_down_by_dc = defaultdict(list)
-        any_node_down = False
         click.echo(
             click.style('Cluster name: {}'.format(self.name), bold=True))
 
@@ -109,9 +129,6 @@ class Cluster:
                 table.align[c] = 'l'
 
             for e in endpoints:
-                if not e.is_alive:
-                    any_node_down = True
-                    nodes_down_by_dc[dc].append(e.name)
                 status = click.style(
                     e.status, fg='green' if e.is_alive else 'red')
 
@@ -126,7 +143,8 @@ class Cluster:
 
             click.echo(table)
 
-        if any_node_down:
+        nodes_down_by_dc = self.nodes_down_by_dc
+        if nodes_down_by_dc:
             click.echo(
                 click.style('Cluster status: Unhealthy',
                             fg='red', bold=True))
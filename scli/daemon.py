@@ -0,0 +1,433 @@
+import json
+import logging
+import os
+import re
+import signal
+import socket
+import socketserver
+import threading
+import time
+from datetime import datetime
+
+from .cluster import Cluster, Ring
+from .repair import (DEFAULT_MAX_PENDING_COMPACTIONS, Repair,
+                     RepairInterrupted)
+
+log = logging.getLogger('scli')
+
+DEFAULT_SOCKET = '/tmp/scli.sock'
+DEFAULT_STATE_FILE = '~/.scli_daemon_{cluster}.json'
+# application states which change when node joins, leaves or moves
+TOPOLOGY_STATES = (0, 13)  # status, tokens
+
+
+def topology_signature(endpoints):
+    """
+    Summarize `endpoints_detailed` response. Signature changes when node
+    is added, removed, restarted, goes up/down or its tokens change
+    :return: sorted list of tuples
+    """
+    signature = []
+    for e in endpoints:
+        states = tuple(sorted(
+            (s['application_state'], s['value'])
+            for s in e['application_state']
+            if s['application_state'] in TOPOLOGY_STATES
+        ))
+        signature.append((e['addrs'], e['generation'], e['is_alive'], states))
+
+    return sorted(signature)
+
+
+def send_command(socket_path, command):
+    """
+    Send control command to the running daemon
+    :return: daemon response (dict)
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock.sendall((command + '\n').encode())
+        f = sock.makefile('rb')
+        return json.loads(f.readline().decode())
+    finally:
+        sock.close()
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        command = self.rfile.readline().decode().strip()
+        try:
+            response = self.server.repair_daemon.control(command)
+        except Exception as e:
+            log.exception('Control command {} failed'.format(command))
+            response = {'error': str(e) or e.__class__.__name__}
+        self.wfile.write((json.dumps(response) + '\n').encode())
+
+
+class ControlServer(socketserver.ThreadingMixIn,
+                    socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, repair_daemon):
+        self.repair_daemon = repair_daemon
+        super().__init__(socket_path, ControlHandler)
+
+
+class RepairDaemon:
+    """
+    Repairs given keyspaces continuously, one (keyspace, endpoint) pair at
+    a time, pacing work so every pair is repaired once per `cycle_time`.
+    API connections and SSH tunnels are kept open for the whole lifetime
+    of the process and the topology is fetched again only when gossip
+    state changes. Progress is stored in `state_file` (`{cluster}` is
+    replaced with cluster name), so a restarted daemon continues the cycle
+    it was working on.
+    """
+    # first delay before a failed (keyspace, endpoint) pair is retried,
+    # doubled after every failure
+    RETRY_DELAY = 60
+    MAX_RETRY_DELAY = 60 * 60
+
+    def __init__(self, client, keyspaces, table=None, hosts=None,
+                 exclude=None, dc=None, local=None, cycle_time=7*24*3600,
+                 refresh_interval=60, socket_path=DEFAULT_SOCKET,
+                 state_file=DEFAULT_STATE_FILE,
+                 max_pending_compactions=DEFAULT_MAX_PENDING_COMPACTIONS):
+        self.client = client
+        self.keyspaces = keyspaces
+        self.table = table
+        self.hosts = hosts
+        self.exclude = exclude
+        self.dc = dc
+        self.local = local
+        self.cycle_time = cycle_time
+        self.refresh_interval = refresh_interval
+        self.socket_path = socket_path
+        self.state_file = state_file
+        self.max_pending_compactions = max_pending_compactions
+
+        self.running = threading.Event()
+        self.running.set()
+        self.stopping = threading.Event()
+
+        self._lock = threading.Lock()
+        # tunnels of a client are reset on connection errors, so the
+        # watcher thread must not share them with the repair
+        self._watcher_client = self.client.clone()
+        endpoints = list(self.client.endpoints_detailed())
+        self._signature = topology_signature(endpoints)
+        self._last_refresh = datetime.now()
+        self._rings = {}
+        self.cluster = Cluster(self.client, endpoints=endpoints)
+        unknown = [k for k in keyspaces if k not in self.cluster.keyspaces]
+        if unknown:
+            raise ValueError('Unknown keyspaces: {}'.format(
+                ', '.join(unknown)))
+        self.state_file = os.path.expanduser(self.state_file.format(
+            cluster=re.sub(r'[^\w.-]', '_', self.cluster.name)))
+        self.current = None
+        # (keyspace, endpoint): (failures, retry_at), guarded by _lock
+        self._retries = {}
+        # (keyspace, endpoint): number of ranges failed in the last attempt
+        self._failed_ranges = {}
+        self.state = self._load_state()
+        self._server = None
+
+    def _load_state(self):
+        if not os.path.exists(self.state_file):
+            return None
+
+        with open(self.state_file, 'r') as f:
+            state = json.load(f)
+
+        if state.get('cluster') != self.cluster.name:
+            log.warning('State in {} belongs to another cluster, '
+                        'ignoring it'.format(self.state_file))
+            return None
+
+        if state.get('keyspaces') != list(self.keyspaces):
+            log.warning('Keyspaces changed, ignoring state from {}'.format(
+                self.state_file))
+            return None
+
+        log.info('Resuming repair cycle {} ({} items done)'.format(
+            state['cycle'], len(state['done'])))
+        return state
+
+    def _save_state(self):
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_file, self.state_file)
+
+    def _new_cycle(self):
+        cycle = self.state['cycle'] + 1 if self.state else 1
+        self.state = {
+            'cycle': cycle,
+            'cycle_start': time.time(),
+            'cluster': self.cluster.name,
+            'keyspaces': list(self.keyspaces),
+            'done': [],
+        }
+        self._save_state()
+
+    def _work_items(self):
+        items = []
+        with self._lock:
+            for keyspace in self.keyspaces:
+                if keyspace not in self.cluster.keyspaces:
+                    log.error('Keyspace {} does not exist, skipping'.format(
+                        keyspace))
+                    continue
+                repair = self._make_repair(keyspace)
+                items.extend([keyspace, e.name] for e in repair.endpoints)
+
+        return items
+
+    def _make_repair(self, keyspace):
+        return Repair(
+            client=self.client,
+            keyspace=keyspace,
+            table=self.table,
+            hosts=self.hosts,
+            exclude=self.exclude,
+            dc=self.dc,
+            local=self.local,
+            cluster=self.cluster,
+            running=self.running,
+            stopping=self.stopping,
+            max_pending_compactions=self.max_pending_compactions,
+        )
+
+    def _repair_item(self, keyspace, endpoint_name):
+        """
+        :return: False if endpoint was busy with another repair or some of
+            its ranges failed
+        """
+        with self._lock:
+            endpoint = self.cluster.endpoints.get(endpoint_name)
+            if endpoint is None:
+                log.warning('Node {} left the cluster, skipping'.format(
+                    endpoint_name))
+                return True
+
+            repair = self._make_repair(keyspace)
+            if keyspace not in self._rings:
+                self._rings[keyspace] = Ring(self.client, keyspace)
+            repair.ring = self._rings[keyspace]
+
+        if not repair.repair_endpoint(endpoint, keyspace):
+            return False
+
+        item = (keyspace, endpoint_name)
+        with self._lock:
+            if repair.failed_ranges:
+                log.error('Repair of {} ranges of {} on {} failed'.format(
+                    len(repair.failed_ranges), keyspace, endpoint_name))
+                self._failed_ranges[item] = len(repair.failed_ranges)
+                return False
+
+            self._failed_ranges.pop(item, None)
+        return True
+
+    def _run_cycle(self):
+        if self.state is None:
+            self._new_cycle()
+
+        items = self._work_items()
+        if not items:
+            log.warning('Nothing to repair, waiting for topology change')
+            self.stopping.wait(timeout=self.refresh_interval)
+            return
+
+        cycle_start = self.state['cycle_start']
+
+        for index, item in enumerate(items):
+            if item in self.state['done'] or not self._may_retry(item):
+                continue
+
+            self.current = item
+            try:
+                repaired = self._repair_item(*item)
+            except RepairInterrupted:
+                return
+            except Exception as e:
+                log.error('Repair of {} on {} failed: {}'.format(
+                    item[0], item[1], e))
+                self._retry_later(item)
+                continue
+            finally:
+                self.current = None
+
+            if not repaired:
+                self._retry_later(item)
+                continue
+
+            with self._lock:
+                self._retries.pop(tuple(item), None)
+            self.state['done'].append(item)
+            self._save_state()
+
+            # spread the work evenly over the cycle
+            scheduled = \
+                cycle_start + self.cycle_time * (index + 1) / len(items)
+            delay = scheduled - time.time()
+            if delay > 0:
+                log.debug('Ahead of schedule, sleeping {:.0f}s'.format(delay))
+                if self.stopping.wait(timeout=delay):
+                    return
+
+        left = [tuple(i) for i in items if i not in self.state['done']]
+        if left:
+            if time.time() < cycle_start + self.cycle_time:
+                # wait for the first failed pair to be retried
+                retry_at = min(self._retries[i][1] for i in left)
+                self.stopping.wait(timeout=max(retry_at - time.time(), 1))
+                return
+
+            log.error('Repair cycle {} is over, not repaired: {}'.format(
+                self.state['cycle'],
+                ', '.join(self._describe(i) for i in left)))
+
+        log.info('Repair cycle {} took {}'.format(
+            self.state['cycle'],
+            datetime.now() - datetime.fromtimestamp(cycle_start)))
+        with self._lock:
+            self._retries = {}
+            self._failed_ranges = {}
+        self._new_cycle()
+
+    def _describe(self, item):
+        description = '{} on {}'.format(*item)
+        failed = self._failed_ranges.get(tuple(item))
+        if failed:
+            description += ' ({} ranges failed)'.format(failed)
+        return description
+
+    def _may_retry(self, item):
+        retry = self._retries.get(tuple(item))
+        return retry is None or retry[1] <= time.time()
+
+    def _retry_later(self, item):
+        failures = self._retries.get(tuple(item), (0, None))[0] + 1
+        delay = min(self.RETRY_DELAY * 2 ** (failures - 1),
+                    self.MAX_RETRY_DELAY)
+        log.info('Retrying repair of {} on {} in {}s'.format(
+            item[0], item[1], delay))
+        with self._lock:
+            self._retries[tuple(item)] = (failures, time.time() + delay)
+
+    def _watch_topology(self):
+        while not self.stopping.wait(timeout=self.refresh_interval):
+            try:
+                endpoints = list(self._watcher_client.endpoints_detailed())
+                signature = topology_signature(endpoints)
+                if signature == self._signature:
+                    continue
+
+                log.info('Cluster topology changed, refreshing')
+                tables = self._watcher_client.tables()
+                with self._lock:
+                    self.client.set_hosts(e['addrs'] for e in endpoints)
+                    self.client.cache.clear()
+                    self.cluster.refresh(endpoints, tables)
+                    self._rings = {}
+                    self._signature = signature
+                    self._last_refresh = datetime.now()
+            except Exception as e:
+                log.error('Topology refresh failed: {}'.format(e))
+
+    def _start_control_server(self):
+        if os.path.exists(self.socket_path):
+            try:
+                send_command(self.socket_path, 'status')
+            except socket.error:
+                os.unlink(self.socket_path)
+            else:
+                raise RuntimeError('Another daemon listens on {}'.format(
+                    self.socket_path))
+
+        self._server = ControlServer(self.socket_path, self)
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def _stop_control_server(self):
+        if self._server is None:
+            return
+
+        self._server.shutdown()
+        self._server.server_close()
+        os.unlink(self.socket_path)
+
+    def control(self, command):
+        if command == 'pause':
+            self.running.clear()
+            log.info('Repair paused')
+        elif command == 'resume':
+            self.running.set()
+            log.info('Repair resumed')
+        elif command != 'status':
+            return {'error': 'Unknown command {}'.format(command)}
+
+        return self.status()
+
+    def status(self):
+        if self.stopping.is_set():
+            state = 'stopping'
+        elif self.running.is_set():
+            state = 'running'
+        else:
+            state = 'paused'
+
+        status = {
+            'state': state,
+            'cluster': self.cluster.name,
+            'endpoints': len(self.cluster.endpoints),
+            'last_topology_refresh': self._last_refresh.isoformat(),
+            'current': self.current,
+            'cache': self.client.cache.stats(),
+        }
+        if self.state is not None:
+            # changed by the repair thread
+            with self._lock:
+                retrying = [self._describe(i) for i in self._retries]
+                failed_ranges = sum(self._failed_ranges.values())
+            status.update({
+                'cycle': self.state['cycle'],
+                'cycle_start': datetime.fromtimestamp(
+                    self.state['cycle_start']).isoformat(),
+                'done': len(self.state['done']),
+                'retrying': sorted(retrying),
+                'failed_ranges': failed_ranges,
+            })
+
+        return status
+
+    def stop(self, *args):
+        log.info('Stopping after current range is repaired')
+        self.stopping.set()
+        # wake up paused repair, so it can exit
+        self.running.set()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        self._start_control_server()
+        watcher = threading.Thread(target=self._watch_topology)
+        watcher.daemon = True
+        watcher.start()
+
+        try:
+            while not self.stopping.is_set():
+                try:
+                    self._run_cycle()
+                except Exception as e:
+                    log.exception('Repair cycle failed: {}'.format(e))
+                    self.stopping.wait(timeout=self.refresh_interval)
+        finally:
+            self._stop_control_server()
+            self._watcher_client.stop_ssh()
+            log.info('Repair daemon stopped')
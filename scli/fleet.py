@@ -0,0 +1,226 @@
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+from datetime import datetime, timedelta
+import logging
+import os
+import signal
+import threading
+
+import click
+from prettytable import PrettyTable
+
+from .api_client import ApiClient
+from .cluster import Cluster
+from .repair import DEFAULT_COVERAGE_FILE, Repair
+
+log = logging.getLogger('scli')
+
+DEFAULT_FLEET_FILE = os.path.expanduser('~/.scli_fleet.ini')
+FLEET_DEFAULTS = {
+    'method': 'ssh',
+    'ssh_username': 'scli',
+    'ssh_pkey': '~/.ssh/id_rsa',
+}
+
+
+class ClusterLogAdapter(logging.LoggerAdapter):
+    """
+    Prefix messages with cluster name
+    """
+    def process(self, msg, kwargs):
+        return '[{}] {}'.format(self.extra['cluster'], msg), kwargs
+
+
+class Fleet:
+    """
+    Many clusters described by an INI file, one section per cluster:
+
+        [DEFAULT]
+        ssh_username = root
+
+        [prod-eu]
+        host = 10.210.92.46
+
+        [prod-us]
+        host = 10.110.12.4
+        method = direct
+
+    Every cluster gets its own `ApiClient`, so connections, tunnels and
+    caches are never shared, and failure of one cluster does not affect
+    the others.
+    """
+
+    def __init__(self, path=DEFAULT_FLEET_FILE, concurrency=4,
+                 ssh_pass=None, clusters=None, defaults=None):
+        """
+        :param concurrency: max number of clusters handled at once
+        :param ssh_pass: SSH key password used for all clusters
+        :param clusters: names of clusters to use, all if not given
+        :param defaults: settings overriding `FLEET_DEFAULTS`, the fleet
+            file still takes precedence
+        """
+        config = ConfigParser(
+            defaults=dict(FLEET_DEFAULTS, **(defaults or {})),
+            interpolation=None)
+        if not config.read(path):
+            raise ValueError('Cannot read fleet file {}'.format(path))
+
+        self.concurrency = concurrency
+        self.ssh_pass = ssh_pass
+        self.stopping = threading.Event()
+        self.clusters = {}
+        for name in config.sections():
+            if clusters and name not in clusters:
+                continue
+            if not config.has_option(name, 'host'):
+                raise ValueError('No host given for cluster {}'.format(name))
+            self.clusters[name] = config[name]
+
+        unknown = set(clusters or []) - set(self.clusters)
+        if unknown:
+            raise ValueError('Unknown clusters: {}'.format(
+                ', '.join(sorted(unknown))))
+
+    def _make_client(self, settings):
+        if settings['method'] == 'direct':
+            return ApiClient(uses_ssh=False, initial_endpoint=settings['host'])
+
+        client = ApiClient(uses_ssh=True)
+        client.setup_ssh(
+            ssh_username=settings['ssh_username'],
+            ssh_pkey=os.path.expanduser(settings['ssh_pkey']),
+            ssh_pass=self.ssh_pass,
+            initial_endpoint=settings['host'],
+        )
+        return client
+
+    def stop(self, *args):
+        log.info('Stopping after current ranges are repaired')
+        self.stopping.set()
+
+    def _run_one(self, name, func):
+        if self.stopping.is_set():
+            return None, 'Not started', timedelta(0)
+
+        client = self._make_client(self.clusters[name])
+        start = datetime.now()
+        try:
+            result = func(name, client)
+            error = None
+        except Exception as e:
+            log.error('Cluster {name}: {error}'.format(name=name, error=e))
+            result, error = None, str(e) or e.__class__.__name__
+        finally:
+            client.stop_ssh()
+
+        return result, error, datetime.now() - start
+
+    def _run(self, func):
+        """
+        Call `func(name, client)` for every cluster, at most `concurrency`
+        at a time. SIGINT and SIGTERM set `stopping`, so running repairs
+        stop after the current range and the rest is not started.
+        :return: {name: (result, error, took)}
+        """
+        handlers = {
+            signum: signal.signal(signum, self.stop)
+            for signum in (signal.SIGINT, signal.SIGTERM)
+        }
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                futures = {
+                    name: executor.submit(self._run_one, name, func)
+                    for name in self.clusters
+                }
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+        return {name: f.result() for name, f in futures.items()}
+
+    @staticmethod
+    def _summary(field_names):
+        table = PrettyTable()
+        table.field_names = field_names
+        table.sortby = 'Cluster'
+        for c in field_names:
+            table.align[c] = 'l'
+        return table
+
+    def status(self):
+        """
+        Print health of every cluster
+        :return: True if all clusters are healthy
+        """
+        def _status(name, client):
+            return Cluster(client)
+
+        results = self._run(_status)
+        table = self._summary(['Cluster', 'Name', 'Nodes', 'Down', 'Status'])
+        healthy = True
+
+        for name, (cluster, error, _) in results.items():
+            if error is not None:
+                healthy = False
+                table.add_row((name, '', '', '',
+                               click.style(error, fg='red')))
+                continue
+
+            nodes_down = sum(cluster.nodes_down_by_dc.values(), [])
+            healthy = healthy and not nodes_down
+            table.add_row((
+                name,
+                cluster.name,
+                len(cluster.endpoints),
+                ', '.join(sorted(nodes_down)),
+                click.style('Unhealthy', fg='red') if nodes_down else
+                click.style('All green!', fg='green'),
+            ))
+
+        click.echo(table)
+        return healthy
+
+    def repair(self, keyspace, table=None, **kwargs):
+        """
+        Repair keyspace on every cluster, see `Repair` for `kwargs`
+        :return: True if all repairs succeeded
+        """
+        def _repair(name, client):
+            # same default as `scli repair`, so --verify sees the results
+            coverage_file = self.clusters[name].get(
+                'coverage_file', DEFAULT_COVERAGE_FILE)
+            _repair = Repair(
+                client=client,
+                keyspace=keyspace,
+                table=table,
+                coverage_file=os.path.expanduser(coverage_file),
+                logger=ClusterLogAdapter(log, {'cluster': name}),
+                stopping=self.stopping,
+                # bars of concurrent repairs would garble the terminal
+                progress_bar=False,
+                **kwargs
+            )
+            _repair.start()
+            return _repair
+
+        results = self._run(_repair)
+        summary = self._summary(['Cluster', 'Failed ranges', 'Took',
+                                 'Status'])
+        succeeded = True
+
+        for name, (_repair, error, took) in results.items():
+            if error is None and not _repair.failed_ranges:
+                status = click.style('OK', fg='green')
+            else:
+                succeeded = False
+                status = click.style(error or 'Failed', fg='red')
+
+            summary.add_row((
+                name,
+                len(_repair.failed_ranges) if _repair else '',
+                took,
+                status,
+            ))
+
+        click.echo(summary)
+        return succeeded
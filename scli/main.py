@@ -1,4 +1,6 @@
 import os
+import sys
+import socket
 import logging
 from logging.handlers import SysLogHandler
 
@@ -8,7 +10,11 @@ import click_log
 import scli as meta
 from scli.api_client import ApiClient
 from .cluster import Cluster
-from .repair import Repair
+from .daemon import (DEFAULT_SOCKET, DEFAULT_STATE_FILE, RepairDaemon,
+                     send_command)
+from .fleet import DEFAULT_FLEET_FILE, Fleet
+from .repair import (DEFAULT_COVERAGE_FILE, DEFAULT_MAX_PENDING_COMPACTIONS,
+                     Repair)
 
 
 click_log.ColorFormatter.colors['info'] = dict(fg="green")
@@ -55,12 +61,25 @@ def _setup_logger(log_to):
 @click_log.simple_verbosity_option(log)
 @click.pass_context
 def cli(ctx, host, method, ssh_username, ssh_pkey, ssh_pass, log_to):
+    _setup_logger(log_to)
+    if ctx.invoked_subcommand == 'fleet':
+        # hosts come from the fleet file, the rest are fleet defaults
+        ctx.obj = {
+            'defaults': {
+                'method': method,
+                'ssh_username': ssh_username,
+                'ssh_pkey': ssh_pkey,
+            },
+            'ssh_pass': ssh_pass,
+        }
+        return
+    if ctx.invoked_subcommand in ('version', 'daemonctl'):
+        return
+
     if host is None:
         click.echo('Either --host or SCYLLA_HOST env should be provided')
         raise click.Abort()
 
-    _setup_logger(log_to)
-
     if method == 'ssh':
         client = ApiClient(uses_ssh=True)
         if ssh_pass:
@@ -82,6 +101,7 @@ def cli(ctx, host, method, ssh_username, ssh_pkey, ssh_pass, log_to):
         ctx.call_on_close(destroy_ssh_tunnels)
     else:
         client = ApiClient(uses_ssh=False, initial_endpoint=host)
+        ctx.call_on_close(client.close)
 
     ctx.obj = client
 
@@ -94,8 +114,19 @@ def cli(ctx, host, method, ssh_username, ssh_pkey, ssh_pass, log_to):
 @click.option('--dc', help='Datacenter to repair')
 @click.option('--local', is_flag=True, help='Repair using hosts in local DC '
                                             'only')
+@click.option('--coverage_file', default=DEFAULT_COVERAGE_FILE,
+              show_default=True, help='Where to store repaired ranges')
+@click.option('--verify', is_flag=True, help='Only report ranges not '
+                                             'repaired by previous runs')
+@click.option('--gaps-only', is_flag=True, help='Repair only ranges not '
+                                                'repaired by previous runs')
+@click.option('--max_pending_compactions', default=0, show_default=True,
+              help='Defer repair of nodes with bigger compaction backlog '
+                   '(e.g. {}), 0 disables'.format(
+                       DEFAULT_MAX_PENDING_COMPACTIONS))
 @click.pass_obj
-def repair(client, keyspace, table, hosts, exclude, dc, local):
+def repair(client, keyspace, table, hosts, exclude, dc, local, coverage_file,
+           verify, gaps_only, max_pending_compactions):
     _repair = Repair(
         client=client,
         keyspace=keyspace,
@@ -104,10 +135,83 @@ def repair(client, keyspace, table, hosts, exclude, dc, local):
         exclude=exclude,
         dc=dc,
         local=local,
+        coverage_file=coverage_file,
+        gaps_only=gaps_only,
+        max_pending_compactions=max_pending_compactions,
     )
+    if verify:
+        if not _repair.verify():
+            sys.exit(1)
+        return
+
     _repair.start()
 
 
+@cli.command(short_help='Repair Scylla Cluster continuously')
+@click.argument('keyspaces', nargs=-1, required=True)
+@click.option('--table', help='Table to repair')
+@click.option('--hosts', multiple=True, help='Hosts to repair')
+@click.option('--exclude', multiple=True, help='Do not repair these hosts')
+@click.option('--dc', help='Datacenter to repair')
+@click.option('--local', is_flag=True, help='Repair using hosts in local DC '
+                                            'only')
+@click.option('--cycle_time', default=168.0, show_default=True,
+              help='Target time (in hours) of repairing all keyspaces once')
+@click.option('--refresh_interval', default=60, show_default=True,
+              help='How often (in seconds) to check for topology changes')
+@click.option('--socket', 'socket_path', default=DEFAULT_SOCKET,
+              show_default=True, help='Control socket path')
+@click.option('--state_file', default=DEFAULT_STATE_FILE, show_default=True,
+              help='Where to store repair progress, {cluster} is replaced '
+                   'with cluster name')
+@click.option('--max_pending_compactions',
+              default=DEFAULT_MAX_PENDING_COMPACTIONS, show_default=True,
+              help='Defer repair of nodes with bigger compaction backlog, '
+                   '0 disables')
+@click.pass_obj
+def daemon(client, keyspaces, table, hosts, exclude, dc, local, cycle_time,
+           refresh_interval, socket_path, state_file,
+           max_pending_compactions):
+    try:
+        _daemon = RepairDaemon(
+            client=client,
+            keyspaces=keyspaces,
+            table=table,
+            hosts=hosts,
+            exclude=exclude,
+            dc=dc,
+            local=local,
+            cycle_time=cycle_time * 3600,
+            refresh_interval=refresh_interval,
+            socket_path=socket_path,
+            state_file=state_file,
+            max_pending_compactions=max_pending_compactions,
+        )
+        _daemon.run()
+    except (RuntimeError, ValueError) as e:
+        log.error(str(e))
+        raise click.Abort()
+
+
+@cli.command(short_help='Pause, resume or query running repair daemon')
+@click.argument('command', type=click.Choice(['pause', 'resume', 'status']))
+@click.option('--socket', 'socket_path', default=DEFAULT_SOCKET,
+              show_default=True, help='Control socket path')
+def daemonctl(command, socket_path):
+    try:
+        response = send_command(socket_path, command)
+    except socket.error:
+        click.echo('No repair daemon listens on {}'.format(socket_path))
+        raise click.Abort()
+    except ValueError:
+        click.echo('Invalid response from repair daemon on {}'.format(
+            socket_path))
+        raise click.Abort()
+
+    for key, value in sorted(response.items()):
+        click.echo('{}: {}'.format(key, value))
+
+
 @cli.command(short_help='Show cluster status')
 @click.pass_obj
 def status(client):
@@ -115,6 +219,72 @@ def status(client):
     c.status()
 
 
+@cli.group(short_help='Manage many clusters at once')
+@click.option('-f', '--fleet_file', envvar='SCYLLA_FLEET_FILE',
+              default=DEFAULT_FLEET_FILE, show_default=True,
+              help='INI file with a section per cluster')
+@click.option('-c', '--concurrency', default=4, show_default=True,
+              help='Max number of clusters handled at once')
+@click.option('--clusters', multiple=True, help='Clusters to use, '
+                                                'all if not given')
+@click.option('-p', '--ssh_pass', is_flag=True,
+              help='Use this flag if your SSH key is protected by password')
+@click.pass_context
+def fleet(ctx, fleet_file, concurrency, clusters, ssh_pass):
+    options = ctx.obj
+    if ssh_pass or options['ssh_pass']:
+        password = click.prompt('Please enter a valid SSH key password',
+                                hide_input=True)
+    else:
+        password = None
+
+    try:
+        ctx.obj = Fleet(
+            path=fleet_file,
+            concurrency=concurrency,
+            ssh_pass=password,
+            clusters=clusters,
+            defaults=options['defaults'],
+        )
+    except ValueError as e:
+        click.echo(str(e))
+        raise click.Abort()
+
+
+@fleet.command('status', short_help='Show status of all clusters')
+@click.pass_obj
+def fleet_status(_fleet):
+    if not _fleet.status():
+        sys.exit(1)
+
+
+@fleet.command('repair', short_help='Repair all clusters')
+@click.argument('keyspace', nargs=1)
+@click.argument('table', nargs=1, required=False)
+@click.option('--dc', help='Datacenter to repair')
+@click.option('--local', is_flag=True, help='Repair using hosts in local DC '
+                                            'only')
+@click.option('--gaps-only', is_flag=True, help='Repair only ranges not '
+                                                'repaired by previous runs')
+@click.option('--max_pending_compactions', default=0, show_default=True,
+              help='Defer repair of nodes with bigger compaction backlog '
+                   '(e.g. {}), 0 disables'.format(
+                       DEFAULT_MAX_PENDING_COMPACTIONS))
+@click.pass_obj
+def fleet_repair(_fleet, keyspace, table, dc, local, gaps_only,
+                 max_pending_compactions):
+    succeeded = _fleet.repair(
+        keyspace,
+        table=table,
+        dc=dc,
+        local=local,
+        gaps_only=gaps_only,
+        max_pending_compactions=max_pending_compactions,
+    )
+    if not succeeded:
+        sys.exit(1)
+
+
 @cli.command(short_help='Print version number')
 def version():
     click.echo(
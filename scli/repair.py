@@ -1,28 +1,81 @@
+import os
 import sys
+import json
+import fcntl
+import tempfile
+from collections import defaultdict
+from functools import reduce
 from time import sleep
 from datetime import datetime
 import logging
 
+import click
+from requests import exceptions
 from tqdm import tqdm
 from .cluster import Cluster, Ring
+from .tokens import TokenRangeSet
 
 
 log = logging.getLogger('scli')
 
+DEFAULT_COVERAGE_FILE = os.path.expanduser('~/.scli_coverage.json')
+DEFAULT_MAX_PENDING_COMPACTIONS = 50
+
+
+class RepairInterrupted(Exception):
+    pass
+
 
 class Repair:
     MAX_FAILURES = 20
+    THROTTLE_SLEEP = 30
+    # repair the least loaded node anyway once all were overloaded this long
+    MAX_THROTTLE_WAIT = 30 * 60
 
     def __init__(self, client, keyspace=None, table=None, dc=None,
-                 hosts=None, exclude=None, local=None):
+                 hosts=None, exclude=None, local=None, cluster=None,
+                 running=None, stopping=None, coverage_file=None,
+                 gaps_only=False, max_pending_compactions=0, logger=None,
+                 progress_bar=True):
+        """
+        :param cluster: already initialized `Cluster`, fetched if not given
+        :param running: `threading.Event`, repair waits before every range
+            until it is set (used for pausing)
+        :param stopping: `threading.Event`, once set `RepairInterrupted` is
+            raised before the next range
+        :param coverage_file: where to keep successfully repaired ranges
+            between runs
+        :param gaps_only: repair only ranges missing in `coverage_file`
+        :param max_pending_compactions: nodes with bigger compaction backlog
+            are deferred until it goes down (at most `MAX_THROTTLE_WAIT`),
+            0 disables throttling
+        :param logger: used instead of the `scli` logger, e.g. to tell
+            clusters apart
+        :param progress_bar: show progress bar on terminal, progress is
+            logged instead if disabled
+        """
+        self.log = logger or log
+        self.progress_bar = progress_bar
         self.client = client
-        self.cluster = Cluster(self.client)
+        self.cluster = cluster or Cluster(self.client)
+        self.running = running
+        self.stopping = stopping
         self.ring = None
         self.table = table
         self.dc = dc
         self.failures = 0
         self.failed_ranges = []
         self.local = local
+        self.coverage_file = coverage_file
+        self.gaps_only = gaps_only
+        self.coverage = self._load_coverage()
+        self.max_pending_compactions = max_pending_compactions
+        self._pending = {}
+        self._remaining = {}
+        # nodes without usable compaction metrics, never throttled
+        self._unthrottled = set()
+        # endpoints skipped because they were already involved in repair
+        self.skipped = []
         if keyspace is None:
             self.keyspaces = self.cluster.keyspaces.keys()
         else:
@@ -46,18 +99,284 @@ class Repair:
                 return False
             return True
 
-        return filter(_filter_endpoint, self.cluster.endpoints.values())
+        return list(
+            filter(_filter_endpoint, self.cluster.endpoints.values()))
+
+    def _read_coverage_file(self):
+        """
+        :return: {cluster_name: {keyspace: {table: [[start, end], ..]}}}
+        """
+        if self.coverage_file is None or \
+                not os.path.exists(self.coverage_file):
+            return {}
+
+        with open(self.coverage_file, 'r') as f:
+            return json.load(f)
+
+    def _load_coverage(self):
+        """
+        Coverage file is shared by clusters, so ranges are kept per cluster
+        :return: {keyspace: {table: TokenRangeSet}}
+        """
+        coverage = defaultdict(lambda: defaultdict(TokenRangeSet))
+        data = self._read_coverage_file().get(self.cluster.name, {})
+        for keyspace, tables in data.items():
+            for table, ranges in tables.items():
+                coverage[keyspace][table] = TokenRangeSet(ranges)
+
+        return coverage
+
+    def _save_coverage(self):
+        if self.coverage_file is None:
+            return
+
+        # runs against other clusters may update the file at the same time,
+        # the lock keeps them from overwriting each other's ranges
+        with open(self.coverage_file + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            data = self._read_coverage_file()
+            data[self.cluster.name] = {
+                keyspace: {
+                    table: list(ranges) for table, ranges in tables.items()}
+                for keyspace, tables in self.coverage.items()
+            }
+
+            fd, tmp_file = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.coverage_file)),
+                prefix=os.path.basename(self.coverage_file) + '.')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(data, f)
+                os.replace(tmp_file, self.coverage_file)
+            except BaseException:
+                os.unlink(tmp_file)
+                raise
+
+    def _expected_ranges(self):
+        """
+        :return: TokenRangeSet of ranges owned by endpoints to repair
+        """
+        expected = TokenRangeSet()
+        for endpoint in self.endpoints:
+            for start, end in self.ring.ranges_for_endpoint(endpoint.name):
+                expected.add(start, end)
+
+        return expected
+
+    def gaps(self, keyspace, expected=None):
+        """
+        :return: {table: TokenRangeSet} of ranges not repaired yet
+        """
+        if expected is None:
+            expected = self._expected_ranges()
+
+        return {
+            table: expected - self.coverage[keyspace][table]
+            for table in self.to_repair
+        }
+
+    def _reset_coverage(self, keyspace):
+        expected = self._expected_ranges()
+        for table in self.to_repair:
+            self.coverage[keyspace][table] = \
+                self.coverage[keyspace][table] - expected
+
+    def _prepare_gaps(self, keyspace):
+        """
+        Split gaps into ranges missing in every table, repaired with one
+        request for the whole keyspace, and the per table remainders
+        """
+        gaps = self.gaps(keyspace)
+        common = TokenRangeSet()
+        if self.table is None and gaps:
+            common = reduce(lambda a, b: a & b, gaps.values())
+
+        self._pending = {None: common}
+        for table, table_gaps in gaps.items():
+            self._pending[table] = table_gaps - common
 
     def start(self):
         repair_start = datetime.now()
 
         for keyspace in self.keyspaces:
             self.ring = Ring(self.client, keyspace)
-            for endpoint in self.endpoints:
-                self._repair_endpoint(endpoint, keyspace, table=self.table)
+            if self.gaps_only:
+                self._prepare_gaps(keyspace)
+            else:
+                self._reset_coverage(keyspace)
+
+            self._repair_endpoints(keyspace)
 
         repair_end = datetime.now()
-        log.info('Repair took {}'.format(repair_end-repair_start))
+        self.log.info('Repair took {}'.format(repair_end-repair_start))
+        if self.failed_ranges:
+            self.log.error(
+                'Repair of {} ranges failed, use --verify to list them and '
+                '--gaps-only to repair them again'.format(
+                    len(self.failed_ranges)))
+
+    def repair_endpoint(self, endpoint, keyspace):
+        """
+        Repair keyspace on a single endpoint, waiting while it is busy
+        compacting (forced after `MAX_THROTTLE_WAIT`). `ring` of keyspace
+        must be set.
+        :return: False if endpoint was already involved in another repair
+        """
+        skipped = len(self.skipped)
+        self._repair_endpoints(keyspace, endpoints=[endpoint])
+        return len(self.skipped) == skipped
+
+    def _repair_endpoints(self, keyspace, endpoints=None):
+        """
+        Repair endpoints starting from the least busy one. Endpoint which
+        gets overloaded with compactions is put aside and continued later.
+        :param endpoints: all endpoints to repair if not given
+        """
+        queue = list(self.endpoints if endpoints is None else endpoints)
+        waiting_since = None
+        try:
+            while queue:
+                endpoint = self._least_loaded(queue)
+                force = False
+                if endpoint is None:
+                    if waiting_since is None:
+                        waiting_since = datetime.now()
+                    waited = (datetime.now() - waiting_since).total_seconds()
+                    if waited < self.MAX_THROTTLE_WAIT:
+                        self.log.info('All nodes are busy compacting, waiting')
+                        self._throttle_sleep()
+                        continue
+
+                    endpoint = self._least_loaded(queue, force=True)
+                    force = True
+                    self.log.warning(
+                        'All nodes are still busy compacting, repairing {} '
+                        'anyway'.format(endpoint.name))
+
+                waiting_since = None
+                if self._repair_endpoint(endpoint, keyspace, table=self.table,
+                                         force=force):
+                    queue.remove(endpoint)
+                self._save_coverage()
+        finally:
+            # keep ranges repaired so far also when repair fails or is
+            # interrupted, so they are not repaired again with --gaps-only
+            self._save_coverage()
+
+    def _throttle_sleep(self):
+        if self.stopping is None:
+            sleep(self.THROTTLE_SLEEP)
+        elif self.stopping.wait(timeout=self.THROTTLE_SLEEP):
+            raise RepairInterrupted()
+
+    def _backlog(self, endpoint):
+        """
+        :return: number of pending and running compactions on endpoint,
+            None if unknown
+        """
+        if endpoint.name in self._unthrottled:
+            return None
+
+        try:
+            return self.client.pending_compactions(endpoint.name) + \
+                len(self.client.compactions(endpoint.name))
+        except exceptions.HTTPError as e:
+            # metrics are missing or broken, asking again will not help
+            self.log.warning(
+                'Cannot get compaction backlog of {}, not throttling its '
+                'repair: {}'.format(endpoint.name, e))
+            self._unthrottled.add(endpoint.name)
+            return None
+        except exceptions.RequestException as e:
+            self.log.warning('Cannot get compaction backlog of {}: {}'.format(
+                endpoint.name, e))
+            return None
+
+    def _overloaded(self, endpoint):
+        """
+        Node with backlog unknown due to connection errors is treated as
+        overloaded
+        """
+        if not self.max_pending_compactions:
+            return False
+
+        backlog = self._backlog(endpoint)
+        if endpoint.name in self._unthrottled:
+            return False
+        if backlog is None or backlog > self.max_pending_compactions:
+            self.log.info('Node {name} has {backlog} compactions queued, '
+                          'deferring its repair'.format(
+                              name=endpoint.name, backlog=backlog))
+            return True
+        return False
+
+    def _least_loaded(self, endpoints, force=False):
+        """
+        :param force: ignore the threshold, nodes with unknown backlog go last
+        :return: endpoint with the smallest compaction backlog below the
+            threshold or None if all of them are overloaded
+        """
+        if not self.max_pending_compactions:
+            return endpoints[0]
+
+        loads = []
+        for index, endpoint in enumerate(endpoints):
+            backlog = self._backlog(endpoint)
+            if endpoint.name in self._unthrottled:
+                # never deferred, but nodes known to be idle go first
+                loads.append((True, 0, index))
+            elif force:
+                loads.append((backlog is None, backlog or 0, index))
+            elif backlog is not None and \
+                    backlog <= self.max_pending_compactions:
+                loads.append((False, backlog, index))
+
+        return endpoints[min(loads)[2]] if loads else None
+
+    def verify(self):
+        """
+        Print token ranges which were not repaired successfully
+        :return: True if all ranges are repaired
+        """
+        covered = True
+        for keyspace in self.keyspaces:
+            self.ring = Ring(self.client, keyspace)
+            expected = self._expected_ranges()
+            total = expected.token_count() or 1
+
+            for table, gaps in sorted(self.gaps(keyspace, expected).items()):
+                if not gaps:
+                    continue
+
+                covered = False
+                ranges = gaps.to_ranges()
+                click.echo(click.style(
+                    '{keyspace}.{table}: {count} gaps, {percent:.2f}% of '
+                    'ring not repaired'.format(
+                        keyspace=keyspace,
+                        table=table,
+                        count=len(ranges),
+                        percent=100. * gaps.token_count() / total),
+                    fg='red', bold=True))
+                for start, end in ranges:
+                    click.echo('  ({}, {}]'.format(start, end))
+
+        if covered:
+            click.echo(click.style('All ranges repaired', fg='green',
+                                   bold=True))
+        return covered
+
+    def _wait_if_paused(self):
+        if self.running is not None:
+            while not self.running.wait(timeout=1):
+                if self._should_stop():
+                    break
+
+        if self._should_stop():
+            raise RepairInterrupted()
+
+    def _should_stop(self):
+        return self.stopping is not None and self.stopping.is_set()
 
     def _check_repair_status(self, endpoint_name, keyspace, rid):
         while True:
@@ -71,18 +390,28 @@ class Repair:
             elif status == '"SUCCESSFUL"':
                 return True
             else:
-                log.warning('Unknown repair status {}'.format(status))
+                self.log.warning('Unknown repair status {}'.format(status))
                 return False
 
-    def _run_repair(self, endpoint, keyspace, table=None):
-        log.info('Repair {keyspace} {table} on {name}'.format(
+    def _run_repair(self, endpoint, keyspace, table=None, token_ranges=None,
+                    force=False):
+        """
+        :param force: do not defer repair due to compaction backlog
+        :return: ranges left unrepaired because endpoint got overloaded
+        """
+        self.log.info('Repair {keyspace} {table} on {name}'.format(
             keyspace=keyspace, table=table or '', name=endpoint.name
         ))
 
-        token_ranges = self.ring.ranges_for_endpoint(endpoint.name)
-        bar = tqdm(token_ranges)
+        if token_ranges is None:
+            token_ranges = self.ring.ranges_for_endpoint(endpoint.name)
+        bar = tqdm(token_ranges, disable=not self.progress_bar)
+
+        for index, (start, end) in enumerate(token_ranges):
+            self._wait_if_paused()
+            if not force and self._overloaded(endpoint):
+                return token_ranges[index:]
 
-        for start, end in token_ranges:
             if not self._repair_range(
                     endpoint, keyspace, start, end, table=table):
                 # TODO: think about better value here or exp backoff
@@ -94,13 +423,15 @@ class Repair:
                             endpoint, keyspace, start, end, table=_table)
 
             bar.update()
-            if not sys.stdout.isatty():
-                log.info('{index}/{max} complete'.format(
-                    index=bar.n, max=bar.total))
+            if not self.progress_bar or not sys.stdout.isatty():
+                self.log.info('{index}/{max} complete'.format(
+                    index=index + 1, max=len(token_ranges)))
 
             if self.failures >= self.MAX_FAILURES:
                 raise Exception('Max number of failures exceeded')
 
+        return []
+
     def _repair_range(self, endpoint, keyspace, start, end, table=None):
         repair_id = self.client.repair_async(
             endpoint.name,
@@ -115,7 +446,8 @@ class Repair:
 
         if not ok and table is not None:
             self.failures += 1
-            log.error(
+            self.failed_ranges.append((keyspace, table, start, end))
+            self.log.error(
                 '\nRepair range ({start}, {end}) cf: {table} on '
                 '{endpoint_name} failed'.format(
                     start=start,
@@ -125,17 +457,56 @@ class Repair:
             )
         if ok:
             self.failures = 0
+            for _table in [table] if table is not None else self.to_repair:
+                self.coverage[keyspace][_table].add(start, end)
         return ok
 
-    def _repair_endpoint(self, endpoint, keyspace, table=None):
+    def _repair_gaps(self, endpoint, keyspace, force=False):
+        """
+        Repair pending gaps owned by endpoint. Every gap is assigned to the
+        first replica only.
+        :return: False if endpoint got overloaded before all were repaired
+        """
+        owned = TokenRangeSet(self.ring.ranges_for_endpoint(endpoint.name))
+        tables = [None] + sorted(t for t in self._pending if t is not None)
+
+        for table in tables:
+            token_ranges = (self._pending[table] & owned).to_ranges()
+            self._pending[table] = self._pending[table] - owned
+            if not token_ranges:
+                continue
+
+            left = self._run_repair(endpoint, keyspace, table=table,
+                                    token_ranges=token_ranges, force=force)
+            if left:
+                self._pending[table].update(TokenRangeSet(left))
+                return False
+
+        return True
+
+    def _repair_endpoint(self, endpoint, keyspace, table=None, force=False):
+        """
+        :param force: do not defer repair due to compaction backlog, applies
+            to this call only
+        :return: False if repair was deferred due to compaction backlog
+        """
         active_repair = self.client.active_repair(endpoint.name)
         if len(active_repair) > 0:
-            log.warning('Node {name} is already involved in repair {repair}'
-                        .format(name=endpoint.name, repair=active_repair))
-            return
+            self.log.warning(
+                'Node {name} is already involved in repair {repair}'.format(
+                    name=endpoint.name, repair=active_repair))
+            self.skipped.append(endpoint.name)
+            return True
 
         self.failures = 0
-        if table is not None:
-            self._run_repair(endpoint, keyspace, table=table)
-        else:
-            self._run_repair(endpoint, keyspace)
+        if self.gaps_only:
+            return self._repair_gaps(endpoint, keyspace, force=force)
+
+        left = self._run_repair(
+            endpoint, keyspace, table=table,
+            token_ranges=self._remaining.pop(endpoint.name, None),
+            force=force)
+        if left:
+            self._remaining[endpoint.name] = left
+            return False
+        return True
@@ -0,0 +1,125 @@
+from bisect import bisect_left, bisect_right
+
+# Murmur3Partitioner token space
+MIN_TOKEN = -2 ** 63
+MAX_TOKEN = 2 ** 63 - 1
+
+
+def split_range(start, end):
+    """
+    Split token range (start, end] into ranges which do not wrap around
+    the ring. Range with start == end covers the whole ring.
+    :return: [(start, end), ..]
+    """
+    start, end = int(start), int(end)
+    if start < end:
+        return [(start, end)]
+    if start == end:
+        return [(MIN_TOKEN, MAX_TOKEN)]
+
+    ranges = []
+    if start < MAX_TOKEN:
+        ranges.append((start, MAX_TOKEN))
+    if end > MIN_TOKEN:
+        ranges.append((MIN_TOKEN, end))
+    return ranges
+
+
+class TokenRangeSet:
+    """
+    Set of token ranges on the ring. Ranges are left-open, right-closed,
+    like the ones returned by `describe_ring`, and may wrap around.
+    Internally kept as sorted, disjoint, non-adjacent intervals.
+    """
+
+    def __init__(self, ranges=()):
+        self._starts = []
+        self._ends = []
+        for start, end in ranges:
+            self.add(start, end)
+
+    @classmethod
+    def _from_sorted(cls, intervals):
+        token_set = cls()
+        for start, end in intervals:
+            token_set._starts.append(start)
+            token_set._ends.append(end)
+        return token_set
+
+    def add(self, start, end):
+        for _start, _end in split_range(start, end):
+            self._add(_start, _end)
+
+    def _add(self, start, end):
+        # intervals overlapping or touching (start, end]
+        lo = bisect_left(self._ends, start)
+        hi = bisect_right(self._starts, end)
+        if lo < hi:
+            start = min(start, self._starts[lo])
+            end = max(end, self._ends[hi - 1])
+        self._starts[lo:hi] = [start]
+        self._ends[lo:hi] = [end]
+
+    def update(self, other):
+        for start, end in other:
+            self._add(start, end)
+
+    def __iter__(self):
+        return iter(zip(self._starts, self._ends))
+
+    def __bool__(self):
+        return bool(self._starts)
+
+    def __eq__(self, other):
+        return isinstance(other, TokenRangeSet) and \
+            list(self) == list(other)
+
+    def __repr__(self):
+        return 'TokenRangeSet({})'.format(list(self.to_ranges()))
+
+    def __or__(self, other):
+        result = TokenRangeSet._from_sorted(self)
+        result.update(other)
+        return result
+
+    def __sub__(self, other):
+        result = []
+        others = list(other)
+        j = 0
+        for start, end in self:
+            while j < len(others) and others[j][1] <= start:
+                j += 1
+
+            k = j
+            while k < len(others) and others[k][0] < end:
+                other_start, other_end = others[k]
+                if other_start > start:
+                    result.append((start, other_start))
+                start = max(start, other_end)
+                if other_end >= end:
+                    break
+                k += 1
+
+            if start < end:
+                result.append((start, end))
+
+        return TokenRangeSet._from_sorted(result)
+
+    def __and__(self, other):
+        return self - (self - other)
+
+    def token_count(self):
+        return sum(e - s for s, e in self)
+
+    def to_ranges(self):
+        """
+        Ranges suitable for repair requests, joining the intervals touching
+        both ends of the ring into one wrapping range
+        :return: [(start, end), ..]
+        """
+        ranges = list(self)
+        if len(ranges) > 1 and ranges[0][0] == MIN_TOKEN \
+                and ranges[-1][1] == MAX_TOKEN:
+            first, last = ranges[0], ranges[-1]
+            ranges = [(last[0], first[1])] + ranges[1:-1]
+        return ranges
@@ -1,4 +1,10 @@
+import codecs
+import json
+import re
+
 size_suffixes = ['B', 'KB', 'MB', 'GB', 'TB', 'PB']
+_whitespace = re.compile(r'[ \t\n\r]*')
+_number_end = ' \t\n\r,]'
 
 
 def humansize(nbytes):
@@ -8,3 +14,72 @@ def humansize(nbytes):
         i += 1
     f = ('%.2f' % nbytes).rstrip('0').rstrip('.')
     return '%s %s' % (f, size_suffixes[i])
+
+
+def iter_json_array(chunks, encoding='utf-8'):
+    """
+    Parse JSON array incrementally and yield its elements one by one, so
+    the whole document never has to be kept in memory
+    :param chunks: iterable of bytes, e.g. `Response.iter_content()`
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(encoding)()
+    buf = ''
+    # what may come next: `[`, first element or `]`, `,` or `]`, element
+    expected = 'start'
+    finished = False
+
+    for chunk in chunks:
+        buf += text_decoder.decode(chunk)
+        pos = 0
+
+        while not finished:
+            pos = _whitespace.match(buf, pos).end()
+            if pos == len(buf):
+                break
+
+            char = buf[pos]
+            if expected == 'start':
+                if char != '[':
+                    raise ValueError('Expected JSON array')
+                expected = 'first'
+                pos += 1
+                continue
+
+            if expected == 'separator':
+                if char == ',':
+                    expected = 'element'
+                    pos += 1
+                elif char == ']':
+                    finished = True
+                else:
+                    raise ValueError(
+                        'Expected , or ] in JSON array, got {!r}'.format(
+                            char))
+                continue
+
+            if expected == 'first' and char == ']':
+                finished = True
+                continue
+
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # element is not complete yet
+                break
+            if end == len(buf) or (
+                    isinstance(obj, (int, float)) and
+                    buf[end] not in _number_end):
+                # a number could continue in the next chunk, e.g. `1` of
+                # `1.5`
+                break
+
+            yield obj
+            expected = 'separator'
+            pos = end
+
+        buf = buf[pos:]
+        if finished:
+            return
+
+    raise ValueError('Unexpected end of JSON array')
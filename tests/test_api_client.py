@@ -0,0 +1,81 @@
+import json
+
+import pytest
+from requests import exceptions
+
+from scli.api_client import ApiClient, ResponseChanged
+
+
+class FakeResponse:
+    def __init__(self, data, break_after=None):
+        raw = json.dumps(data).encode()
+        self.chunks = [raw[i:i + 8] for i in range(0, len(raw), 8)]
+        self.break_after = break_after
+
+    def iter_content(self, chunk_size=None):
+        for index, chunk in enumerate(self.chunks):
+            if index == self.break_after:
+                raise exceptions.ChunkedEncodingError('connection reset')
+            yield chunk
+
+    def close(self):
+        pass
+
+
+def _client(responses):
+    client = ApiClient(uses_ssh=False, initial_endpoint='127.0.0.1')
+    responses = iter(responses)
+    client._request = lambda *args, **kwargs: next(responses)
+    return client
+
+
+def test_get_iter_retries_broken_body():
+    data = [{'start_token': str(i), 'end_token': str(i + 1)}
+            for i in range(20)]
+    client = _client([
+        FakeResponse(data, break_after=10),
+        FakeResponse(data, break_after=30),
+        FakeResponse(data),
+    ])
+
+    assert list(client._get_iter('/path')) == data
+
+
+def test_get_iter_response_changed():
+    data = list(range(100, 120))
+    client = _client([
+        FakeResponse(data, break_after=10),
+        FakeResponse(list(reversed(data))),
+    ])
+
+    with pytest.raises(ResponseChanged):
+        list(client._get_iter('/path'))
+
+
+def test_get_iter_gives_up():
+    data = list(range(100, 120))
+    client = _client([FakeResponse(data, break_after=1)] * 20)
+    client.total_retries = 2
+
+    with pytest.raises(exceptions.ChunkedEncodingError):
+        list(client._get_iter('/path'))
+
+
+def test_get_iter_compares_keys_only():
+    data = [{'addrs': '10.0.0.{}'.format(i), 'update_time': i}
+            for i in range(20)]
+    updated = [dict(e, update_time=e['update_time'] + 100) for e in data]
+    client = _client([
+        FakeResponse(data, break_after=20),
+        FakeResponse(updated),
+    ])
+
+    result = list(client._get_iter('/path', key=lambda e: e['addrs']))
+    assert [e['addrs'] for e in result] == [e['addrs'] for e in data]
+
+    client = _client([
+        FakeResponse(data, break_after=20),
+        FakeResponse(updated),
+    ])
+    with pytest.raises(ResponseChanged):
+        list(client._get_iter('/path'))
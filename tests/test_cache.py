@@ -0,0 +1,96 @@
+import threading
+import time
+
+import pytest
+
+from scli.cache import ResponseCache
+
+
+def test_ttl():
+    cache = ResponseCache()
+    values = iter([1, 2, 3])
+
+    assert cache.get_or_fetch('k', 10, lambda: next(values)) == 1
+    assert cache.get_or_fetch('k', 10, lambda: next(values)) == 1
+    assert cache.stats()['hits'] == 1
+
+    assert cache.get_or_fetch('e', 0.01, lambda: next(values)) == 2
+    time.sleep(0.02)
+    assert cache.get_or_fetch('e', 0.01, lambda: next(values)) == 3
+    assert cache.stats()['misses'] == 3
+
+
+def test_zero_ttl_is_not_stored():
+    cache = ResponseCache()
+    values = iter([1, 2])
+
+    assert cache.get_or_fetch('k', 0, lambda: next(values)) == 1
+    assert cache.get_or_fetch('k', 0, lambda: next(values)) == 2
+    assert cache.stats()['size'] == 0
+
+
+def test_lru_eviction():
+    cache = ResponseCache(max_size=2)
+    cache.get_or_fetch('a', 10, lambda: 'a')
+    cache.get_or_fetch('b', 10, lambda: 'b')
+    # touch `a`, so `b` is the least recently used one
+    cache.get_or_fetch('a', 10, lambda: 'x')
+    cache.get_or_fetch('c', 10, lambda: 'c')
+
+    assert cache.get_or_fetch('a', 10, lambda: 'x') == 'a'
+    assert cache.get_or_fetch('b', 10, lambda: 'y') == 'y'
+    assert cache.stats()['size'] == 2
+
+
+def _concurrent(cache, fetch, count=10):
+    results, errors = [], []
+    started = threading.Event()
+
+    def _call():
+        started.wait()
+        try:
+            results.append(cache.get_or_fetch('k', 10, fetch))
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=_call) for _ in range(count)]
+    for t in threads:
+        t.start()
+    started.set()
+    for t in threads:
+        t.join()
+    return results, errors
+
+
+def test_singleflight():
+    cache = ResponseCache()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        time.sleep(0.2)
+        return 'value'
+
+    results, errors = _concurrent(cache, fetch)
+
+    assert calls == [1]
+    assert results == ['value'] * 10
+    assert not errors
+    assert cache.stats()['coalesced'] == 9
+
+
+@pytest.mark.parametrize('error', [ValueError, KeyboardInterrupt])
+def test_error_is_shared(error):
+    cache = ResponseCache()
+
+    def fetch():
+        time.sleep(0.2)
+        raise error()
+
+    results, errors = _concurrent(cache, fetch)
+
+    assert not results
+    assert len(errors) == 10
+    assert all(isinstance(e, error) for e in errors)
+    # errors are not cached
+    assert cache.get_or_fetch('k', 10, lambda: 'ok') == 'ok'
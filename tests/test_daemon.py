@@ -0,0 +1,284 @@
+import json
+
+import pytest
+from click.testing import CliRunner
+
+from scli.cache import ResponseCache
+from scli.daemon import RepairDaemon, send_command, topology_signature
+from scli.main import cli
+
+
+def _states(tokens='1', heartbeat=1):
+    return [
+        {'application_state': 0, 'value': 'NORMAL'},
+        {'application_state': 3, 'value': 'dc1'},
+        {'application_state': 4, 'value': 'rack1'},
+        {'application_state': 5, 'value': '1'},
+        {'application_state': 13, 'value': tokens},
+        {'application_state': 14, 'value': ''},
+        {'application_state': 15, 'value': ''},
+        {'application_state': 16, 'value': str(heartbeat)},
+    ]
+
+
+def _endpoint(addrs, generation=1, is_alive=True, **kwargs):
+    return {
+        'addrs': addrs,
+        'generation': generation,
+        'is_alive': is_alive,
+        'application_state': _states(**kwargs),
+    }
+
+
+class FakeClient:
+    """
+    Cluster of nodes a and b with one keyspace. Repair requests fail
+    `fail[host]` times and nodes are busy with another repair `busy[host]`
+    times.
+    """
+    def __init__(self):
+        self.cache = ResponseCache()
+        self.repaired = []
+        self.fail = {}
+        self.busy = {}
+        self.status = '"SUCCESSFUL"'
+
+    def clone(self):
+        return self
+
+    def set_hosts(self, hosts):
+        pass
+
+    def stop_ssh(self):
+        pass
+
+    def cluster_name(self):
+        return 'test cluster'
+
+    def endpoints_detailed(self):
+        return iter([_endpoint('a'), _endpoint('b')])
+
+    def tables(self):
+        return [{'ks': 'ks', 'cf': 't1'}, {'ks': 'other', 'cf': 't1'}]
+
+    def describe_ring(self, keyspace):
+        return iter([
+            {'start_token': '100', 'end_token': '-100',
+             'endpoint_details': [{'host': 'a'}, {'host': 'b'}]},
+            {'start_token': '-100', 'end_token': '100',
+             'endpoint_details': [{'host': 'b'}, {'host': 'a'}]},
+        ])
+
+    def active_repair(self, host):
+        if self.busy.get(host):
+            self.busy[host] -= 1
+            return [1]
+        return []
+
+    def pending_compactions(self, host):
+        return 0
+
+    def compactions(self, host):
+        return []
+
+    def repair_async(self, host, keyspace, table=None, start_token=None,
+                     end_token=None, dc=None):
+        if self.fail.get(host):
+            self.fail[host] -= 1
+            raise RuntimeError('repair failed')
+        self.repaired.append((keyspace, host))
+        return 1
+
+    def repair_status(self, host, keyspace, repair_id):
+        return self.status
+
+
+class FakeEvent:
+    """
+    Never set, waiting returns immediately
+    """
+    def __init__(self):
+        self.waits = []
+
+    def is_set(self):
+        return False
+
+    def wait(self, timeout=None):
+        self.waits.append(timeout)
+        return False
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr('scli.repair.sleep', lambda seconds: None)
+    return FakeClient()
+
+
+def _daemon(client, tmpdir, keyspaces=('ks',)):
+    daemon = RepairDaemon(
+        client, list(keyspaces), cycle_time=3600,
+        state_file=str(tmpdir.join('state_{cluster}.json')))
+    daemon.stopping = FakeEvent()
+    return daemon
+
+
+def test_topology_signature():
+    endpoints = [_endpoint('a'), _endpoint('b')]
+    signature = topology_signature(endpoints)
+
+    assert topology_signature(reversed(endpoints)) == signature
+    assert topology_signature(
+        [_endpoint('a', heartbeat=2), _endpoint('b')]) == signature
+    for changed in (_endpoint('a', generation=2),
+                    _endpoint('a', is_alive=False),
+                    _endpoint('a', tokens='2')):
+        assert topology_signature([changed, _endpoint('b')]) != signature
+    assert topology_signature(endpoints[:1]) != signature
+
+
+def test_state_file_per_cluster(client, tmpdir):
+    daemon = _daemon(client, tmpdir)
+    assert daemon.state_file == str(tmpdir.join('state_test_cluster.json'))
+
+
+def test_unknown_keyspaces(client, tmpdir):
+    with pytest.raises(ValueError, match='Unknown keyspaces: missing'):
+        _daemon(client, tmpdir, keyspaces=['ks', 'missing'])
+
+
+def _write_state(tmpdir, **kwargs):
+    state = {
+        'cycle': 3,
+        'cycle_start': 0,
+        'cluster': 'test cluster',
+        'keyspaces': ['ks'],
+        'done': [['ks', 'a']],
+    }
+    state.update(kwargs)
+    tmpdir.join('state_test_cluster.json').write(json.dumps(state))
+
+
+def test_load_state(client, tmpdir):
+    _write_state(tmpdir)
+    assert _daemon(client, tmpdir).state['cycle'] == 3
+
+
+def test_load_state_of_another_cluster(client, tmpdir):
+    _write_state(tmpdir, cluster='other cluster')
+    assert _daemon(client, tmpdir).state is None
+
+
+def test_load_state_with_other_keyspaces(client, tmpdir):
+    _write_state(tmpdir, keyspaces=['ks', 'other'])
+    assert _daemon(client, tmpdir).state is None
+
+
+def test_run_cycle_skips_done(client, tmpdir, monkeypatch):
+    monkeypatch.setattr('time.time', lambda: 1000)
+    _write_state(tmpdir, cycle_start=1000)
+    daemon = _daemon(client, tmpdir)
+    daemon._run_cycle()
+
+    assert client.repaired == [('ks', 'b')] * 2
+    # all pairs are done, next cycle is started
+    assert daemon.state['cycle'] == 4
+    assert daemon.state['done'] == []
+
+
+def test_run_cycle_retries_with_backoff(client, tmpdir, monkeypatch):
+    now = [1000]
+    monkeypatch.setattr('time.time', lambda: now[0])
+    client.fail = {'a': 2}
+    client.busy = {'b': 1}
+    daemon = _daemon(client, tmpdir)
+
+    daemon._run_cycle()
+    assert daemon.state['done'] == []
+    assert daemon._retries == {('ks', 'a'): (1, 1060),
+                               ('ks', 'b'): (1, 1060)}
+    # waits for the first retry
+    assert daemon.stopping.waits[-1] == 60
+
+    daemon._run_cycle()
+    assert client.repaired == []
+
+    now[0] = 1060
+    daemon._run_cycle()
+    assert daemon.state['done'] == [['ks', 'b']]
+    assert daemon._retries == {('ks', 'a'): (2, 1180)}
+
+    now[0] = 1180
+    daemon._run_cycle()
+    assert sorted(set(client.repaired)) == [('ks', 'a'), ('ks', 'b')]
+    assert daemon._retries == {}
+    assert daemon.state['cycle'] == 2
+
+
+def test_run_cycle_retries_failed_ranges(client, tmpdir, monkeypatch):
+    monkeypatch.setattr('time.time', lambda: 1000)
+    client.status = '"FAILED"'
+    daemon = _daemon(client, tmpdir)
+
+    daemon._run_cycle()
+    assert daemon.state['done'] == []
+    assert sorted(daemon._retries) == [('ks', 'a'), ('ks', 'b')]
+
+    status = daemon.status()
+    assert status['failed_ranges'] == 4
+    assert status['retrying'] == ['ks on a (2 ranges failed)',
+                                  'ks on b (2 ranges failed)']
+
+
+def test_run_cycle_over(client, tmpdir, monkeypatch):
+    monkeypatch.setattr('time.time', lambda: 5000)
+    _write_state(tmpdir, cycle_start=1000, done=[])
+    client.fail = {'a': 1}
+    daemon = _daemon(client, tmpdir)
+    daemon._run_cycle()
+
+    # cycle time is over, pair which failed is left for the next cycle
+    assert daemon.state['cycle'] == 4
+    assert daemon.state['done'] == []
+    assert daemon._retries == {}
+
+
+def test_control(client, tmpdir):
+    daemon = _daemon(client, tmpdir)
+
+    assert daemon.control('pause')['state'] == 'paused'
+    assert not daemon.running.is_set()
+    assert daemon.control('status')['state'] == 'paused'
+
+    status = daemon.control('resume')
+    assert status['state'] == 'running'
+    assert daemon.running.is_set()
+    assert status['cluster'] == 'test cluster'
+    assert status['endpoints'] == 2
+
+    assert daemon.control('restart') == {'error': 'Unknown command restart'}
+
+
+def test_daemonctl_invalid_response(monkeypatch):
+    def _send_command(socket_path, command):
+        raise ValueError('Expecting value')
+
+    monkeypatch.setattr('scli.main.send_command', _send_command)
+    result = CliRunner().invoke(cli, ['daemonctl', 'status'])
+
+    assert result.exit_code == 1
+    assert 'Invalid response from repair daemon' in result.output
+
+
+def test_control_socket(client, tmpdir):
+    daemon = _daemon(client, tmpdir)
+    daemon.socket_path = str(tmpdir.join('scli.sock'))
+    daemon._start_control_server()
+    try:
+        assert send_command(daemon.socket_path, 'pause')['state'] == 'paused'
+        with pytest.raises(RuntimeError, match='Another daemon listens'):
+            daemon._start_control_server()
+
+        daemon.cluster = None
+        assert 'error' in send_command(daemon.socket_path, 'status')
+    finally:
+        daemon._stop_control_server()
@@ -0,0 +1,143 @@
+import os
+import signal
+
+import pytest
+from click.testing import CliRunner
+
+from scli.fleet import Fleet
+from scli.main import cli
+from scli.repair import DEFAULT_COVERAGE_FILE
+
+
+def _fleet_file(tmpdir, content):
+    path = tmpdir.join('fleet.ini')
+    path.write(content)
+    return str(path)
+
+
+def test_signal_stops_fleet(tmpdir):
+    path = _fleet_file(tmpdir, '\n'.join(
+        '[c{}]\nhost = 10.0.0.{}\nmethod = direct'.format(i, i)
+        for i in range(4)))
+    fleet = Fleet(path, concurrency=2)
+    started = []
+
+    def _wait(name, client):
+        started.append(name)
+        if len(started) == 2:
+            os.kill(os.getpid(), signal.SIGTERM)
+        assert fleet.stopping.wait(timeout=10)
+        raise RuntimeError('interrupted')
+
+    handler = signal.getsignal(signal.SIGTERM)
+    results = fleet._run(_wait)
+
+    assert len(started) == 2
+    assert sorted(error for _, error, _ in results.values()) == \
+        ['Not started', 'Not started', 'interrupted', 'interrupted']
+    assert signal.getsignal(signal.SIGTERM) == handler
+
+
+def test_cli_options_are_fleet_defaults(tmpdir, monkeypatch):
+    path = _fleet_file(tmpdir, '[DEFAULT]\nssh_pkey = /etc/key\n\n'
+                               '[c1]\nhost = 10.0.0.1\n')
+    fleets = []
+    monkeypatch.setattr(Fleet, 'status',
+                        lambda self: fleets.append(self) or True)
+
+    result = CliRunner().invoke(
+        cli, ['-u', 'root', '-k', '/home/key', '-p', 'fleet', '-f', path,
+              'status'], input='secret\n')
+
+    assert result.exit_code == 0, result.output
+    assert fleets[0].ssh_pass == 'secret'
+    settings = fleets[0].clusters['c1']
+    assert settings['ssh_username'] == 'root'
+    assert settings['ssh_pkey'] == '/etc/key'
+    assert settings['method'] == 'ssh'
+
+
+class FakeRepair:
+    created = []
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.failed_ranges = []
+        FakeRepair.created.append(self)
+
+    def start(self):
+        pass
+
+
+def test_repair_uses_default_coverage_file(tmpdir, monkeypatch):
+    path = _fleet_file(tmpdir, '[c1]\nhost = 10.0.0.1\nmethod = direct\n\n'
+                               '[c2]\nhost = 10.0.0.2\nmethod = direct\n'
+                               'coverage_file = /tmp/c2.json\n')
+    monkeypatch.setattr('scli.fleet.Repair', FakeRepair)
+    FakeRepair.created = []
+
+    assert Fleet(path).repair('ks')
+    coverage_files = {r.kwargs['logger'].extra['cluster']:
+                      r.kwargs['coverage_file'] for r in FakeRepair.created}
+    assert coverage_files == {'c1': DEFAULT_COVERAGE_FILE,
+                              'c2': '/tmp/c2.json'}
+
+
+def test_default_settings_are_inherited(tmpdir):
+    path = _fleet_file(tmpdir, '[DEFAULT]\nssh_username = root\n\n'
+                               '[c1]\nhost = 10.0.0.1\n\n'
+                               '[c2]\nhost = 10.0.0.2\nssh_username = c2\n')
+    clusters = Fleet(path).clusters
+
+    assert sorted(clusters) == ['c1', 'c2']
+    assert clusters['c1']['ssh_username'] == 'root'
+    assert clusters['c2']['ssh_username'] == 'c2'
+    assert clusters['c1']['method'] == 'ssh'
+
+
+def test_missing_host(tmpdir):
+    path = _fleet_file(tmpdir, '[c1]\nhost = 10.0.0.1\n\n[c2]\n')
+    with pytest.raises(ValueError, match='No host given for cluster c2'):
+        Fleet(path)
+
+    assert list(Fleet(path, clusters=['c1']).clusters) == ['c1']
+
+
+def test_unknown_clusters(tmpdir):
+    path = _fleet_file(tmpdir, '[c1]\nhost = 10.0.0.1\n')
+    with pytest.raises(ValueError, match='Unknown clusters: c2, c3'):
+        Fleet(path, clusters=['c3', 'c1', 'c2'])
+
+
+def test_missing_fleet_file(tmpdir):
+    with pytest.raises(ValueError, match='Cannot read fleet file'):
+        Fleet(str(tmpdir.join('missing.ini')))
+
+
+def test_make_client(tmpdir):
+    path = _fleet_file(tmpdir, '[DEFAULT]\nssh_pkey = ~/key\n\n'
+                               '[c1]\nhost = 10.0.0.1\nmethod = direct\n\n'
+                               '[c2]\nhost = 10.0.0.2\n')
+    fleet = Fleet(path, ssh_pass='secret')
+
+    client = fleet._make_client(fleet.clusters['c1'])
+    assert not client.uses_ssh
+    assert client.initial_endpoint == '10.0.0.1'
+
+    client = fleet._make_client(fleet.clusters['c2'])
+    assert client.uses_ssh
+    assert client._ssh_settings == {
+        'initial_endpoint': '10.0.0.2',
+        'ssh_username': 'scli',
+        'ssh_pkey': os.path.expanduser('~/key'),
+        'ssh_pass': 'secret',
+    }
+
+
+def test_repair_without_progress_bars(tmpdir, monkeypatch):
+    path = _fleet_file(tmpdir, '[c1]\nhost = 10.0.0.1\nmethod = direct\n')
+    monkeypatch.setattr('scli.fleet.Repair', FakeRepair)
+    FakeRepair.created = []
+
+    assert Fleet(path).repair('ks')
+    assert FakeRepair.created[0].kwargs['progress_bar'] is False
@@ -0,0 +1,256 @@
+import json
+import os
+import threading
+
+import pytest
+from requests import exceptions
+
+from scli.cluster import Keyspace
+from scli.repair import Repair, RepairInterrupted
+
+
+class FakeCluster:
+    def __init__(self, name):
+        self.name = name
+        self.endpoints = {}
+        self.keyspaces = {'ks': Keyspace('ks', {'t1'})}
+
+
+def test_coverage_is_kept_per_cluster(tmpdir):
+    coverage_file = str(tmpdir.join('coverage.json'))
+
+    repair_a = Repair(None, keyspace='ks', cluster=FakeCluster('a'),
+                      coverage_file=coverage_file)
+    repair_a.coverage['ks']['t1'].add(0, 100)
+    repair_a._save_coverage()
+
+    repair_b = Repair(None, keyspace='ks', cluster=FakeCluster('b'),
+                      coverage_file=coverage_file)
+    assert not repair_b.coverage['ks']['t1']
+    repair_b.coverage['ks']['t1'].add(-100, 0)
+    repair_b._save_coverage()
+
+    repair_a = Repair(None, keyspace='ks', cluster=FakeCluster('a'),
+                      coverage_file=coverage_file)
+    assert repair_a.coverage['ks']['t1'].to_ranges() == [(0, 100)]
+
+
+class FakeEndpoint:
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeClient:
+    """
+    Backlog None means node is unreachable, 'missing' that it has no
+    compaction metrics
+    """
+    def __init__(self, backlogs):
+        self.backlogs = backlogs
+        self.probes = 0
+
+    def pending_compactions(self, host):
+        self.probes += 1
+        backlog = self.backlogs[host]
+        if backlog is None:
+            raise exceptions.ConnectionError('unreachable')
+        if backlog == 'missing':
+            raise exceptions.HTTPError('404 Client Error: Not Found')
+        return backlog
+
+    def compactions(self, host):
+        return []
+
+
+def _repair(backlogs, max_pending_compactions=50):
+    return Repair(FakeClient(backlogs), keyspace='ks',
+                  cluster=FakeCluster('a'),
+                  max_pending_compactions=max_pending_compactions)
+
+
+def test_least_loaded():
+    endpoints = [FakeEndpoint(n) for n in 'abc']
+    repair = _repair({'a': 40, 'b': 10, 'c': 30})
+    assert repair._least_loaded(endpoints).name == 'b'
+
+
+def test_least_loaded_skips_unknown_and_overloaded():
+    endpoints = [FakeEndpoint(n) for n in 'abc']
+    repair = _repair({'a': None, 'b': 100, 'c': 60})
+    assert repair._least_loaded(endpoints) is None
+    assert repair._least_loaded(endpoints, force=True).name == 'c'
+    assert repair._overloaded(endpoints[0])
+
+
+def test_missing_metrics_disable_throttling():
+    endpoints = [FakeEndpoint(n) for n in 'abc']
+    repair = _repair({'a': 'missing', 'b': 100, 'c': 30})
+    assert repair._least_loaded(endpoints).name == 'c'
+    assert not repair._overloaded(endpoints[0])
+
+    repair.client.backlogs['c'] = 60
+    assert repair._least_loaded(endpoints).name == 'a'
+    probes = repair.client.probes
+    assert not repair._overloaded(endpoints[0])
+    assert repair.client.probes == probes
+
+
+def test_throttling_disabled():
+    endpoints = [FakeEndpoint(n) for n in 'ab']
+    repair = _repair({'a': None, 'b': 100}, max_pending_compactions=0)
+    assert repair._least_loaded(endpoints).name == 'a'
+    assert not repair._overloaded(endpoints[0])
+
+
+class FakeRing:
+    def __init__(self, ranges):
+        self.ranges = ranges
+
+    def ranges_for_endpoint(self, name):
+        return self.ranges[name]
+
+
+class FakeRepairClient:
+    """
+    Repairs succeed until `fail_at`-th request, which raises the error
+    """
+    def __init__(self, fail_at, error):
+        self.fail_at = fail_at
+        self.error = error
+        self.requests = 0
+
+    def active_repair(self, host):
+        return []
+
+    def repair_async(self, host, keyspace, table=None, start_token=None,
+                     end_token=None, dc=None):
+        self.requests += 1
+        if self.requests == self.fail_at:
+            raise self.error
+        return self.requests
+
+    def repair_status(self, host, keyspace, repair_id):
+        return '"SUCCESSFUL"'
+
+
+def test_coverage_saved_when_repair_breaks(tmpdir, monkeypatch):
+    monkeypatch.setattr('scli.repair.sleep', lambda seconds: None)
+    coverage_file = str(tmpdir.join('coverage.json'))
+    cluster = FakeCluster('a')
+    cluster.endpoints = {'n1': FakeEndpoint('n1')}
+    client = FakeRepairClient(
+        fail_at=2, error=exceptions.ConnectionError('unreachable'))
+
+    repair = Repair(client, keyspace='ks', cluster=cluster,
+                    coverage_file=coverage_file)
+    repair.ring = FakeRing({'n1': [(0, 100), (100, 200)]})
+    with pytest.raises(exceptions.ConnectionError):
+        repair._repair_endpoints('ks')
+
+    repair = Repair(None, keyspace='ks', cluster=cluster,
+                    coverage_file=coverage_file)
+    assert repair.coverage['ks']['t1'].to_ranges() == [(0, 100)]
+
+
+def test_concurrent_coverage_updates(tmpdir):
+    coverage_file = str(tmpdir.join('coverage.json'))
+    repairs = [Repair(None, keyspace='ks', cluster=FakeCluster(str(i)),
+                      coverage_file=coverage_file) for i in range(8)]
+
+    def _save(repair):
+        for i in range(20):
+            repair.coverage['ks']['t1'].add(i * 10, i * 10 + 5)
+            repair._save_coverage()
+
+    threads = [threading.Thread(target=_save, args=(r,)) for r in repairs]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    with open(coverage_file) as f:
+        data = json.load(f)
+    assert sorted(data) == [str(i) for i in range(8)]
+    assert all(len(c['ks']['t1']) == 20 for c in data.values())
+    assert sorted(os.listdir(str(tmpdir))) == \
+        ['coverage.json', 'coverage.json.lock']
+
+
+class FakeBusyClient(FakeRepairClient):
+    def __init__(self, backlog):
+        super().__init__(fail_at=None, error=None)
+        self.backlog = backlog
+
+    def pending_compactions(self, host):
+        return self.backlog
+
+    def compactions(self, host):
+        return []
+
+
+def test_force_applies_to_one_call(monkeypatch):
+    monkeypatch.setattr('scli.repair.sleep', lambda seconds: None)
+    cluster = FakeCluster('a')
+    endpoint = FakeEndpoint('n1')
+    cluster.endpoints = {'n1': endpoint}
+    client = FakeBusyClient(backlog=100)
+
+    repair = Repair(client, keyspace='ks', cluster=cluster,
+                    max_pending_compactions=50)
+    repair.ring = FakeRing({'n1': [(0, 100), (100, 200)]})
+    assert not repair._repair_endpoint(endpoint, 'ks')
+    assert client.requests == 0
+
+    assert repair._repair_endpoint(endpoint, 'ks', force=True)
+    assert client.requests == 2
+
+    # next keyspace is throttled again
+    assert not repair._repair_endpoint(endpoint, 'ks')
+    assert client.requests == 2
+
+
+def test_repair_endpoint_waits_then_forces(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr('scli.repair.sleep', sleeps.append)
+    cluster = FakeCluster('a')
+    endpoint = FakeEndpoint('n1')
+    cluster.endpoints = {'n1': endpoint}
+    client = FakeBusyClient(backlog=100)
+
+    repair = Repair(client, keyspace='ks', cluster=cluster,
+                    max_pending_compactions=50)
+    repair.MAX_THROTTLE_WAIT = 0
+    repair.ring = FakeRing({'n1': [(0, 100), (100, 200)]})
+    assert repair.repair_endpoint(endpoint, 'ks')
+    assert client.requests == 2
+
+
+def test_repair_endpoint_interrupted_while_waiting():
+    cluster = FakeCluster('a')
+    endpoint = FakeEndpoint('n1')
+    cluster.endpoints = {'n1': endpoint}
+    stopping = threading.Event()
+    stopping.set()
+
+    repair = Repair(FakeBusyClient(backlog=100), keyspace='ks',
+                    cluster=cluster, stopping=stopping,
+                    max_pending_compactions=50)
+    repair.ring = FakeRing({'n1': [(0, 100)]})
+    with pytest.raises(RepairInterrupted):
+        repair.repair_endpoint(endpoint, 'ks')
+
+
+def test_progress_logged_without_bar(capsys, caplog, monkeypatch):
+    monkeypatch.setattr('scli.repair.sleep', lambda seconds: None)
+    cluster = FakeCluster('a')
+    endpoint = FakeEndpoint('n1')
+    cluster.endpoints = {'n1': endpoint}
+
+    repair = Repair(FakeRepairClient(fail_at=None, error=None),
+                    keyspace='ks', cluster=cluster, progress_bar=False)
+    repair.ring = FakeRing({'n1': [(0, 100), (100, 200)]})
+    with caplog.at_level('INFO', logger='scli'):
+        assert repair._run_repair(endpoint, 'ks') == []
+
+    assert '%' not in capsys.readouterr().err
+    assert '2/2 complete' in caplog.text
@@ -0,0 +1,89 @@
+import random
+
+import pytest
+
+from scli.tokens import MAX_TOKEN, MIN_TOKEN, TokenRangeSet, split_range
+
+
+def _tokens(ranges, lo=-60, hi=60):
+    """
+    Brute force model: tokens covered by ranges in a small part of the ring
+    """
+    covered = set()
+    for start, end in ranges:
+        for token in range(lo, hi + 1):
+            if start < end and start < token <= end:
+                covered.add(token)
+            elif start >= end and (token > start or token <= end):
+                covered.add(token)
+    return covered
+
+
+def _random_ranges(count):
+    ranges = []
+    for _ in range(count):
+        start = random.randint(-50, 50)
+        ranges.append((start, start + random.randint(-20, 20)))
+    return ranges
+
+
+def test_split_range():
+    assert split_range('-5', '5') == [(-5, 5)]
+    assert split_range(5, -5) == [(5, MAX_TOKEN), (MIN_TOKEN, -5)]
+    assert split_range(MAX_TOKEN, 0) == [(MIN_TOKEN, 0)]
+    assert split_range(10, MIN_TOKEN) == [(10, MAX_TOKEN)]
+
+
+def test_split_range_whole_ring():
+    assert split_range(7, 7) == [(MIN_TOKEN, MAX_TOKEN)]
+
+
+def test_add_merges_overlapping_and_adjacent():
+    token_set = TokenRangeSet([(0, 10), (20, 30), (10, 15), (25, 40)])
+    assert list(token_set) == [(0, 15), (20, 40)]
+
+
+def test_add_wraparound():
+    token_set = TokenRangeSet([(100, -100)])
+    assert list(token_set) == [(MIN_TOKEN, -100), (100, MAX_TOKEN)]
+    assert token_set.to_ranges() == [(100, -100)]
+
+
+def test_to_ranges_joins_ring_ends():
+    token_set = TokenRangeSet([(50, -50), (0, 10)])
+    assert token_set.to_ranges() == [(50, -50), (0, 10)]
+    assert TokenRangeSet([(1, 1)]).to_ranges() == [(MIN_TOKEN, MAX_TOKEN)]
+    assert TokenRangeSet().to_ranges() == []
+
+
+def test_sub_and_wraparound():
+    ring = TokenRangeSet([(0, 0)])
+    repaired = TokenRangeSet([(-100, 100)])
+
+    gaps = ring - repaired
+    assert gaps.to_ranges() == [(100, -100)]
+    assert (gaps & TokenRangeSet([(90, -90)])).to_ranges() == [(100, -100)]
+    assert (gaps & repaired).to_ranges() == []
+    assert not ring - (gaps | repaired)
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_against_model(seed):
+    random.seed(seed)
+    a, b = _random_ranges(4), _random_ranges(4)
+    set_a, set_b = TokenRangeSet(a), TokenRangeSet(b)
+    tokens_a, tokens_b = _tokens(a), _tokens(b)
+
+    assert _tokens(set_a.to_ranges()) == tokens_a
+    assert _tokens((set_a - set_b).to_ranges()) == tokens_a - tokens_b
+    assert _tokens((set_a & set_b).to_ranges()) == tokens_a & tokens_b
+    assert _tokens((set_a | set_b).to_ranges()) == tokens_a | tokens_b
+
+    intervals = list(set_a)
+    for (_, end), (start, _) in zip(intervals, intervals[1:]):
+        assert end < start
+
+
+def test_token_count():
+    assert TokenRangeSet([(0, 10), (5, 20)]).token_count() == 20
+    assert TokenRangeSet([(3, 3)]).token_count() == MAX_TOKEN - MIN_TOKEN
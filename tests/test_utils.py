@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+from scli.utils import humansize, iter_json_array
+
+
+DATA = [
+    {'start_token': '-100', 'end_token': '100',
+     'endpoint_details': [{'host': '10.0.0.1', 'dc': 'zażółć ]",'}]},
+    12345,
+    'text',
+    [],
+    {},
+    -1.5e10,
+    None,
+]
+
+
+def _chunks(raw, size):
+    return [raw[i:i + size] for i in range(0, len(raw), size)]
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 64, 10 ** 6])
+def test_iter_json_array_chunk_boundaries(size):
+    raw = json.dumps(DATA, ensure_ascii=False).encode()
+    assert list(iter_json_array(_chunks(raw, size))) == DATA
+
+
+@pytest.mark.parametrize('raw', [b'[]', b' [ ] ', b'\n[\n]\n'])
+def test_iter_json_array_empty(raw):
+    assert list(iter_json_array(_chunks(raw, 1))) == []
+
+
+def test_iter_json_array_number_split_between_chunks():
+    assert list(iter_json_array([b'[1', b'0,2', b'3]'])) == [10, 23]
+
+
+@pytest.mark.parametrize('raw', [
+    b'[1 2 3]',
+    b'[1,2',
+    b'{"a": 1}',
+    b'[1,]',
+    b'',
+])
+def test_iter_json_array_invalid(raw):
+    for size in (1, 100):
+        with pytest.raises(ValueError):
+            list(iter_json_array(_chunks(raw, size)))
+
+
+def test_humansize():
+    assert humansize(0) == '0 B'
+    assert humansize(1536) == '1.5 KB'
+    assert humansize(1024 ** 3) == '1 GB'